@@ -0,0 +1,125 @@
+import os
+import time
+import numpy as np
+from scipy import sparse
+from prism_model import PrismModel
+
+
+def first_occurrence_ids(ids):
+    '''
+    Renumbers block ids in the order of their first state, so that the block of state 0 is block 0
+    '''
+    _, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse]
+
+
+def lumping_partition(transitions, valuations, digits=10):
+    '''
+    Coarsest probabilistic bisimulation of a DTMC that respects the given state valuations, by partition
+    refinement: blocks are split by the probability mass their states send into every block until no
+    block splits. Probabilities are compared rounded to the given number of digits.
+    '''
+    n = transitions.shape[0]
+    transitions = transitions.tocsr()
+    blocks = first_occurrence_ids(valuations)
+    num_blocks = blocks.max() + 1
+    rng = np.random.default_rng(0)
+    while True:
+        # mass of every state into every block, summarized by a random linear hash of the row
+        membership = sparse.csr_matrix((np.ones(n), (np.arange(n), blocks)), shape=(n, num_blocks))
+        mass = (transitions @ membership).tocsr()
+        mass.sum_duplicates()
+        weights = rng.integers(1, 2**63, size=num_blocks, dtype=np.uint64)
+        scaled = np.rint(mass.data * 10**digits).astype(np.uint64) * weights[mass.indices]
+        signature = np.zeros(n, dtype=np.uint64)
+        nonempty = np.diff(mass.indptr) > 0
+        signature[nonempty] = np.add.reduceat(scaled, mass.indptr[:-1][nonempty])
+
+        order = np.lexsort((signature, blocks))
+        change = np.ones(n, dtype=bool)
+        change[1:] = (blocks[order][1:] != blocks[order][:-1]) | (signature[order][1:] != signature[order][:-1])
+        refined = np.empty(n, dtype=np.int64)
+        refined[order] = np.cumsum(change) - 1
+        refined = first_occurrence_ids(refined)
+        if refined.max() + 1 == num_blocks:
+            return blocks
+        blocks = refined
+        num_blocks = blocks.max() + 1
+
+
+def quotient(dtmc, label_names):
+    '''
+    Bisimulation quotient of the DTMC over the given labels: returns the quotient transition matrix (one
+    state per block, with the transitions of its first state lumped by block), the initial block and
+    the labels of the blocks
+    '''
+    valuations = np.zeros(dtmc.num_states, dtype=np.int64)
+    for i, name in enumerate(label_names):
+        if name not in dtmc.labels:
+            raise ValueError(f'Unknown label "{name}" in the model')
+        valuations |= dtmc.labels[name].astype(np.int64) << i
+    blocks = lumping_partition(dtmc.transitions, valuations)
+    num_blocks = blocks.max() + 1
+
+    _, representatives = np.unique(blocks, return_index=True)
+    membership = sparse.csr_matrix((np.ones(dtmc.num_states), (np.arange(dtmc.num_states), blocks)), shape=(dtmc.num_states, num_blocks))
+    transitions = (dtmc.transitions.tocsr()[representatives] @ membership).tocsr()
+    labels = {name: dtmc.labels[name][representatives] for name in label_names}
+    return transitions, int(blocks[dtmc.initial]), labels
+
+
+def write_prism_model(transitions, initial, labels, pm_file):
+    '''
+    Writes an explicit DTMC as a PRISM model with a single state variable
+    '''
+    n = transitions.shape[0]
+    with open(pm_file, 'w') as f:
+        f.write('dtmc\n\nmodule quotient\n')
+        f.write(f'    s : [0..{n - 1}] init {initial};\n')
+        for state in range(n):
+            start, end = transitions.indptr[state], transitions.indptr[state + 1]
+            updates = ' + '.join(f"{prob!r} : (s'={succ})" for succ, prob in zip(transitions.indices[start:end], transitions.data[start:end].tolist()))
+            f.write(f'    [] s={state} -> {updates};\n')
+        f.write('endmodule\n\n')
+        for name, values in labels.items():
+            states = np.flatnonzero(values)
+            expr = ' | '.join(f's={state}' for state in states) if len(states) else 'false'
+            f.write(f'label "{name}" = {expr};\n')
+
+
+def quotient_models(models, atoms, labels, folder):
+    '''
+    Replaces every model by its bisimulation quotient over the atoms, written to folder. The label
+    definitions are evaluated on the original models and are part of the quotient models. Returns the
+    quotient model files and the state counts.
+    '''
+    label_names = []
+    for atom in atoms:
+        if not (atom.startswith('"') and atom.endswith('"')):
+            raise ValueError(f'Atom {atom} is not a label, cannot build the quotient models')
+        label_names.append(atom[1:-1])
+
+    t0 = time.time()
+    quotient_files = []
+    sizes = []
+    for pm_file in models:
+        dtmc = PrismModel.from_file(pm_file).build()
+        if labels:
+            dtmc.add_labels(labels)
+        transitions, initial, block_labels = quotient(dtmc, label_names)
+        quotient_file = os.path.join(folder, 'quotient_' + os.path.basename(pm_file))
+        write_prism_model(transitions, initial, block_labels, quotient_file)
+        quotient_files.append(quotient_file)
+        sizes.append((dtmc.num_states, transitions.shape[0]))
+        print(f'Quotient of {pm_file}: {dtmc.num_states} -> {transitions.shape[0]} states')
+
+    model_states = sum(size[0] for size in sizes)
+    quotient_states = sum(size[1] for size in sizes)
+    stats = {'model_states': model_states,
+             'quotient_states': quotient_states,
+             'quotient_reduction': round(1 - quotient_states / model_states, 3) if model_states else 0,
+             'quotient_sizes': ';'.join(f'{os.path.basename(pm_file)}:{size[0]}>{size[1]}' for pm_file, size in zip(models, sizes)),
+             'quotient_time': round(time.time() - t0, 3)}
+    return quotient_files, stats
@@ -3,6 +3,56 @@ import heapq as hq
 import time
 
 PRQUERY = "=?"
+# formulas whose best threshold is below the cutoff are not combined
+THRESHOLD_CUTOFF = 0.5
+
+
+def best_thresholds(positive_matrix, negative_matrix):
+    '''
+    For every row, the midpoint threshold between consecutive sorted values that classifies the most
+    examples correctly (positives >= threshold, negatives < threshold), with a single sorted
+    cumulative-count sweep. Rows without any correct classification get a best class of 0.
+    '''
+    num_rows, num_pos = positive_matrix.shape
+    combined = np.concatenate((positive_matrix, negative_matrix), axis=1)
+    n = combined.shape[1]
+    if n < 2:
+        return np.zeros(num_rows, dtype=np.int64), np.zeros(num_rows)
+
+    order = np.argsort(combined, axis=1, kind='stable')
+    combined_vector = np.take_along_axis(combined, order, axis=1)
+    is_positive = order < num_pos
+    positives_before = np.zeros((num_rows, n+1), dtype=np.int64)
+    positives_before[:, 1:] = np.cumsum(is_positive, axis=1)
+
+    # number of values strictly below each threshold: all values up to i if the threshold is above the
+    # i-th value, otherwise (ties) the values before the group of values equal to the i-th value
+    thresholds = (combined_vector[:, :-1] + combined_vector[:, 1:])/2
+    new_group = np.ones((num_rows, n), dtype=bool)
+    new_group[:, 1:] = combined_vector[:, 1:] != combined_vector[:, :-1]
+    group_start = np.maximum.accumulate(np.where(new_group, np.arange(n), 0), axis=1)
+    below = np.where(thresholds > combined_vector[:, :-1], np.arange(1, n), group_start[:, :-1])
+
+    positives_below = np.take_along_axis(positives_before, below, axis=1)
+    curr_class = (num_pos - positives_below) + (below - positives_below)
+
+    # first threshold with the maximal number of correctly classified examples
+    best = np.argmax(curr_class, axis=1)
+    best_class = curr_class[np.arange(num_rows), best]
+    best_threshold = thresholds[np.arange(num_rows), best]
+    return best_class, best_threshold
+
+
+def pack_rows(bits):
+    '''
+    Packs the rows of a boolean matrix into bitsets of uint64 words
+    '''
+    packed = np.packbits(bits, axis=1, bitorder='little')
+    padding = (-packed.shape[1]) % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
 
 class Boolcomb:
     def __init__(self, max_size, max_initial_set, delta):
@@ -12,6 +62,8 @@ class Boolcomb:
         self.max_size = max_size
         self.thresholds = {}
         self.formula_vector_binary = {}
+        self.positive_mask = None
+        self.negative_mask = None
         self.size = {}
         self.all_results = {}
         self.time = 0
@@ -20,111 +72,100 @@ class Boolcomb:
         self.formula_counter = 0
 
     def score(self, formula, formula_size, formula_satisfaction_vector):
-        #arrange the results vector in sorted order
-        
-        t0 = time.time()
+
         positive_vector = formula_satisfaction_vector[0]
         negative_vector = formula_satisfaction_vector[1]
-        combined_vector = np.sort(np.concatenate((positive_vector, negative_vector)))
-
-        #print("Formula: ", formula, positive_vector, negative_vector)
-
-        best_class = 0
-        best_threshold = None
-
-        # find the minimum misclassification error
-        for i in range(len(combined_vector)-1):
-            #if (combined_vector[i+1] - combined_vector[i]) < self.delta:
-            #    continue
-            threshold = (combined_vector[i] + combined_vector[i+1])/2
-            curr_class = sum(positive_vector >= threshold) + sum(negative_vector < threshold)
-            
-            if curr_class > best_class:
-                best_class = curr_class
-                best_threshold = threshold
-
-        if best_threshold is None:
-            self.thresholds[formula] = 0
-            return 0
-
-        self.thresholds[formula] = best_threshold
-        self.formula_vector_binary[formula] =[np.array(positive_vector >= best_threshold), np.array(negative_vector >= best_threshold)]
+        return self.score_batch([formula], formula_size, positive_vector[None, :], negative_vector[None, :])[0]
+
+    def score_batch(self, formulas, formula_size, positive_matrix, negative_matrix):
+        '''
+        Scores all formulas (rows of the result matrices) of a batch at once
+        '''
+        t0 = time.time()
+        best_class, best_threshold = best_thresholds(positive_matrix, negative_matrix)
+
         # sqaure root of formula size
         formula_size_factor = np.sqrt(formula_size) + 1
-        
-        score = (best_class)/(formula_size_factor)
-        #if formula == 'P=? [ F ("a") ]':
-        #    print(formula, positive_vector, negative_vector, best_threshold)
-        
+        scores = best_class/formula_size_factor
+
+        # satisfaction of the examples at the threshold, one packed bitset row per formula
+        num_pos, num_neg = positive_matrix.shape[1], negative_matrix.shape[1]
+        if self.positive_mask is None:
+            self.positive_mask = pack_rows(np.arange(num_pos+num_neg)[None, :] < num_pos)[0]
+            self.negative_mask = pack_rows(np.arange(num_pos+num_neg)[None, :] >= num_pos)[0]
+        threshold_column = best_threshold[:, None]
+        packed = pack_rows(np.concatenate((positive_matrix >= threshold_column, negative_matrix >= threshold_column), axis=1))
+        for i in range(len(formulas)):
+            formula = formulas[i]
+            if best_class[i] == 0:
+                self.thresholds[formula] = 0
+                continue
+            self.thresholds[formula] = best_threshold[i]
+            self.formula_vector_binary[formula] = packed[i]
+
         t1 = time.time()
         self.time += t1-t0
-        return score
+        return scores
 
 
     def search(self):
-        
+
         t0 = time.time()
         print("Heap size: ", len(self.heap))
 
         #print(self.heap)
 
-        initial_list = hq.nsmallest(10, self.heap)
+        initial_list = hq.nsmallest(self.max_initial_set, self.heap)
         found = False
         curr_max_size = self.max_size
         #print('Max size now', self.max_size)
 
+        # packed satisfaction vectors of the heap entries that can be combined, in heap order
+        entries = [elem for elem in self.heap if self.thresholds[elem[1]] >= THRESHOLD_CUTOFF]
+        if not entries:
+            initial_list = []
+        else:
+            vectors = np.stack([self.formula_vector_binary[elem[1]] for elem in entries])
+            sizes = np.array([self.size[elem[1]] for elem in entries])
+            entry_index = {}
+            for i, elem in enumerate(entries):
+                entry_index.setdefault(elem, []).append(i)
 
         for elem1 in initial_list:
             curr_formula = elem1[1]
-            if self.thresholds[curr_formula] < 0.5:
+            if self.thresholds[curr_formula] < THRESHOLD_CUTOFF:
                 continue
 
-            for elem2 in self.heap:
-                if elem1 == elem2:
-                    continue
-                new_formula = elem2[1]
-                if self.thresholds[new_formula] < 0.5:
-                    continue
-                # misclass of And of two formulas
-                #print("Current formula: ", curr_formula, self.formula_vector_binary[curr_formula])
-                #print("New formula: ", new_formula, self.formula_vector_binary[new_formula])
-                bool_comb_size = self.size[curr_formula] + self.size[new_formula] + 1
-                if bool_comb_size > curr_max_size:
-                    continue
-                
-                and_formula_satisfaction = [np.logical_and(self.formula_vector_binary[curr_formula][0], self.formula_vector_binary[new_formula][0]), np.logical_and(self.formula_vector_binary[curr_formula][1], self.formula_vector_binary[new_formula][1])]
-                
-                or_formula_satisfaction = [np.logical_or(self.formula_vector_binary[curr_formula][0], self.formula_vector_binary[new_formula][0]), np.logical_or(self.formula_vector_binary[curr_formula][1], self.formula_vector_binary[new_formula][1])]
-                
-                self.formula_counter += 2
-
-                if and_formula_satisfaction[0].all() and not(and_formula_satisfaction[1].any()):
-                    curr_formula_res = curr_formula.replace(PRQUERY, '>'+str(round(self.thresholds[curr_formula],5))) 
-                    new_formula_res = new_formula.replace(PRQUERY, '>'+str(round(self.thresholds[new_formula],5)))
-                    result_formula = curr_formula_res + ' & ' + new_formula_res
-                    found = True
-                    curr_max_size = bool_comb_size
-                    self.max_size = bool_comb_size
-                    try:
-                        if result_formula not in self.all_results[curr_max_size]:
-                            self.all_results[curr_max_size].append(result_formula)
-                    except:
-                        self.all_results[curr_max_size] = [result_formula]
-
-                
-                if or_formula_satisfaction[0].all() and not(or_formula_satisfaction[1].any()):
-                    curr_formula_res = curr_formula.replace(PRQUERY, '>'+str(round(self.thresholds[curr_formula],5))) 
-                    new_formula_res = new_formula.replace(PRQUERY, '>'+str(round(self.thresholds[new_formula],5)))
-                    result_formula = curr_formula_res + ' | ' + new_formula_res
-                    found = True
-                    curr_max_size = bool_comb_size
-                    self.max_size = bool_comb_size
-                    try:
-                        if result_formula not in self.all_results[curr_max_size]:
-                            self.all_results[curr_max_size].append(result_formula)
-                    except:
-                        self.all_results[curr_max_size] = [result_formula]
-                
+            # AND/OR of the formula with all heap entries at once
+            curr_vector = self.formula_vector_binary[curr_formula]
+            and_hits = self.separating(vectors & curr_vector)
+            or_hits = self.separating(vectors | curr_vector)
+            hits = and_hits | or_hits
+            bool_comb_sizes = sizes + self.size[curr_formula] + 1
+            candidates = np.ones(len(entries), dtype=bool)
+            candidates[entry_index.get(elem1, [])] = False
+
+            # a hit lowers the size bound for the heap entries after it
+            start = 0
+            while True:
+                valid = candidates[start:] & (bool_comb_sizes[start:] <= curr_max_size)
+                hit_positions = np.flatnonzero(valid & hits[start:])
+                if len(hit_positions) == 0:
+                    self.formula_counter += 2*int(np.count_nonzero(valid))
+                    break
+                j = start + hit_positions[0]
+                self.formula_counter += 2*int(np.count_nonzero(valid[:j-start+1]))
+
+                new_formula = entries[j][1]
+                found = True
+                curr_max_size = int(bool_comb_sizes[j])
+                self.max_size = curr_max_size
+                if and_hits[j]:
+                    self.add_result(curr_formula, new_formula, ' & ', curr_max_size)
+                if or_hits[j]:
+                    self.add_result(curr_formula, new_formula, ' | ', curr_max_size)
+                start = j + 1
+
         t1 = time.time()
         self.time += t1-t0
 
@@ -134,3 +175,17 @@ class Boolcomb:
             return True    
 
         return False
+
+    def separating(self, vectors):
+        '''
+        Rows of packed satisfaction vectors that are true on all positive and false on all negative examples
+        '''
+        return np.all(vectors & self.positive_mask == self.positive_mask, axis=1) & ~np.any(vectors & self.negative_mask, axis=1)
+
+    def add_result(self, curr_formula, new_formula, operator, size):
+
+        curr_formula_res = curr_formula.replace(PRQUERY, '>'+str(round(self.thresholds[curr_formula],5)))
+        new_formula_res = new_formula.replace(PRQUERY, '>'+str(round(self.thresholds[new_formula],5)))
+        result_formula = curr_formula_res + operator + new_formula_res
+        if result_formula not in self.all_results.setdefault(size, []):
+            self.all_results[size].append(result_formula)
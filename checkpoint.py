@@ -0,0 +1,116 @@
+import json
+import os
+import pickle
+
+
+# attributes that make up the state of a learning run, saved after every (size, depth) batch
+GRAMMAR_STATE = ['formula_list', 'current_size', 'fingerprints', 'heuristics', 'heuristics_counter', 'heuristics_times', 'total_time',
+                 'total_formula_counter']
+SEPARATOR_STATE = ['all_results', 'max_diff', 'max_diff_formula', 'discard_counter', 'separation_time', 'PRISM_time',
+                   'coarse_time', 'refine_time', 'refined', 'abort_skipped', 'abort_completed', 'deferred_checked', 'chunk_stats',
+                   'formulas', 'results', 'discards']
+PREFILTER_STATE = ['checked', 'dropped', 'time']
+PIPELINE_STATE = ['dropped', 'wait_time']
+NATIVE_STATE = ['incremental_evaluations', 'automaton_evaluations']
+
+
+def object_state(obj, attributes):
+    return {attribute: getattr(obj, attribute) for attribute in attributes if hasattr(obj, attribute)}
+
+
+def restore_state(obj, state):
+    for attribute, value in state.items():
+        setattr(obj, attribute, value)
+
+
+class Checkpoint:
+    '''
+    On-disk checkpoint of a learning run: after every (size, depth) batch, the enumerated formulas (after the
+    discard and observational equivalence pruning), the results of the batch, the boolean combination search
+    and the counters and timers are pickled, so that an interrupted run continues after its last complete batch.
+    The checkpoint is written to a temporary file and renamed, an interrupted write leaves the previous one.
+    A checkpoint is only resumed by a run with the same configuration, which is also recorded next to the info
+    file of a complete run.
+    '''
+    def __init__(self, path, config, config_file):
+
+        self.path = path
+        self.config = config
+        self.config_file = config_file
+
+    def save(self, batch, flags, grammar, sep, bsc, prefilter=None, pipeline=None):
+
+        state = {'config': self.config,
+                 'batch': batch,
+                 'flags': flags,
+                 'grammar': object_state(grammar, GRAMMAR_STATE),
+                 'separator': object_state(sep, SEPARATOR_STATE),
+                 'bsc': bsc}
+        if prefilter is not None:
+            state['prefilter'] = object_state(prefilter, PREFILTER_STATE)
+        if pipeline is not None:
+            state['pipeline'] = object_state(pipeline, PIPELINE_STATE)
+        if sep.backend == 'native':
+            state['native'] = object_state(sep.native_checker, NATIVE_STATE)
+        temp = f'{self.path}.{os.getpid()}'
+        with open(temp, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path)
+
+    def load(self):
+        '''
+        Returns the saved state, or None if there is no checkpoint of this configuration
+        '''
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            print(f'Could not read the checkpoint {self.path}: {e}')
+            return None
+        if state['config'] != self.config:
+            print(f'The checkpoint {self.path} is of another configuration, starting over')
+            return None
+        return state
+
+    def restore(self, state, grammar, sep, bsc, prefilter=None, pipeline=None):
+        '''
+        Restores the saved state into the objects of the run, returns the Boolcomb instance to continue with
+        '''
+        restore_state(grammar, state['grammar'])
+        restore_state(sep, state['separator'])
+        if prefilter is not None and 'prefilter' in state:
+            restore_state(prefilter, state['prefilter'])
+        if pipeline is not None and 'pipeline' in state:
+            restore_state(pipeline, state['pipeline'])
+        if sep.backend == 'native' and 'native' in state:
+            restore_state(sep.native_checker, state['native'])
+        sep.bsc = state['bsc']
+        return state['bsc']
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def is_complete(self, info_file):
+        '''
+        Whether a run of this configuration is complete: its info file and configuration exist without a checkpoint
+        '''
+        if self.exists() or not os.path.exists(info_file) or not os.path.exists(self.config_file):
+            return False
+        with open(self.config_file, 'r') as f:
+            # compared after a JSON round trip, e.g. tuples become lists
+            return json.load(f) == json.loads(json.dumps(self.config))
+
+    def complete(self):
+        '''
+        Records the configuration of the complete run and removes the checkpoint
+        '''
+        with open(self.config_file, 'w') as f:
+            json.dump(self.config, f)
+        self.remove()
+
+    def remove(self):
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,4 +1,12 @@
 from prob_logics import *
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import multiprocessing
+import pickle
+import queue
+import threading
+import numpy as np
 import spot
 import time
 import os
@@ -7,6 +15,8 @@ import os
 #PATH_OPS = ['X', 'U', 'F', 'G']
 
 PRQUERY = "=?"
+# number of formulas (or pairs of formulas) enumerated by a shard of gen_next_size
+SHARD_SIZE = 20000
 
 def syntax_heur(f1, f2):
     # returns true if f1 = f2 syntactically
@@ -41,16 +51,22 @@ def spot_syntax_heur(f1, f2):
     # returns true if f1 = f2 syntactically
     return spot_syntax_equiv(f1, f2) or spot_syntax_neg_equiv(f1, f2)
 
-def spot_simplify_heur(f1):
+def spot_simplify_heur(f1, memo=None):
+    if memo is not None:
+        return memo.lookup('simplify', f1, None, lambda: spot_simplify_heur(f1))
     g = f1.spot_formula.simplify()
     if f1.spot_formula != g or spot.length(g) < f1.tree_size:
         #print(f1, g)
         return True
     return False
     
-def spot_semantic_heur(f1, f2, c):
+def spot_semantic_heur(f1, f2, c, memo=None):
     #print(f1.spot_formula,f2.spot_formula, spot.are_equivalent(f1.spot_formula, f2.spot_formula))
-    contain = c.contained(f1.spot_formula, f2.spot_formula) or c.contained(f2.spot_formula, f1.spot_formula)
+    if memo is not None:
+        contained = lambda g1, g2: memo.lookup('contained', g1, g2, lambda: c.contained(g1.spot_formula, g2.spot_formula))
+    else:
+        contained = lambda g1, g2: c.contained(g1.spot_formula, g2.spot_formula)
+    contain = contained(f1, f2) or contained(f2, f1)
     #equiv = c.equal(f1.spot_formula, f2.spot_formula)# contain better than equiv
 
     return contain
@@ -90,25 +106,135 @@ def spot_syntax_neg_equiv(f1, f2):
     return f1.spot_formula == f2.left.spot_formula
 
 
+class SpotMemo:
+    '''
+    Bounded LRU memo of the spot containment and simplification results, keyed by the uids of the interned
+    formulas. Entries keep their formulas alive, so that a grammar building the same formulas again gets the
+    same uids. Results can be saved to disk by formula string and reused by later runs over the same atoms.
+    The memo of a shard worker process also collects the results it computes, to send them to the parent.
+    '''
+    def __init__(self, max_entries=1000000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        # loaded results by formula strings, moved to the entries when first looked up
+        self.stored = {}
+        # results computed since the last take_computed by formula strings, None outside of shard workers
+        self.computed = None
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, kind, f1, f2, compute):
+
+        key = (kind, f1.uid, None if f2 is None else f2.uid)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+        text_key = self.text_key(kind, f1, f2) if self.stored else None
+        if text_key in self.stored:
+            self.hits += 1
+            result = self.stored.pop(text_key)
+        else:
+            self.misses += 1
+            result = compute()
+            if self.computed is not None:
+                self.computed[self.text_key(kind, f1, f2)] = result
+
+        self.entries[key] = (result, f1, f2)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return result
+
+    def text_key(self, kind, f1, f2):
+        return (kind, f1.prettyPrint(), None if f2 is None else f2.prettyPrint())
+
+    def load(self, memo_file):
+        '''
+        Adds the results saved in the file (if it exists)
+        '''
+        if os.path.exists(memo_file):
+            with open(memo_file, 'rb') as f:
+                self.add_stored(pickle.load(f))
+
+    def add_stored(self, results):
+        '''
+        Adds results by formula strings, e.g. loaded from a file or computed by a shard worker
+        '''
+        for text_key, result in results.items():
+            self.stored.setdefault(text_key, result)
+
+    def take_computed(self):
+        '''
+        Returns the results computed since the last call by formula strings
+        '''
+        computed, self.computed = self.computed, {}
+        return computed
+
+    def save(self, memo_file):
+        '''
+        Saves the results by formula string, merged with the results other runs saved in the meantime
+        '''
+        stored = OrderedDict()
+        if os.path.exists(memo_file):
+            with open(memo_file, 'rb') as f:
+                stored.update(pickle.load(f))
+        stored.update(dict(self.stored))
+        # snapshot of the entries, the enumeration may run in another thread (pipeline)
+        for key, (result, f1, f2) in list(self.entries.items()):
+            stored[self.text_key(key[0], f1, f2)] = result
+        while len(stored) > self.max_entries:
+            stored.popitem(last=False)
+        temp_file = f'{memo_file}.{os.getpid()}'
+        with open(temp_file, 'wb') as f:
+            pickle.dump(stored, f)
+        os.replace(temp_file, memo_file)
+
+    def stats(self):
+
+        lookups = self.hits + self.misses
+        return {'spot_memo_hits': self.hits,
+                'spot_memo_hit_rate': round(self.hits / lookups, 3) if lookups else 0}
+
+
+# one memo per atom set, shared by all the grammars of the process
+spot_memos = {}
+
+def get_spot_memo(atoms):
+    return spot_memos.setdefault(frozenset(atoms), SpotMemo())
+
+def spot_memo_file(folder, atoms):
+    '''
+    File of the saved spot results of an atom set
+    '''
+    atoms_hash = hashlib.sha256(' '.join(sorted(atoms)).encode()).hexdigest()[:16]
+    return os.path.join(folder, f'spot_memo_{atoms_hash}.pkl')
+
+
 class GrammarGenPLTL:
     '''
     PLTL Grammar Generator, its enumerates LTL formulas adding a P operator
     '''
-    def __init__(self, atoms, max_depth=1, max_size=3) -> None:
+    def __init__(self, atoms, max_depth=1, max_size=3, num_workers=1) -> None:
         self.max_depth = 1
         self.current_size = 1
         self.max_depth = max_depth
         self.max_size = max_size
         self.formula_list = {}
         self.atoms = atoms
+        # processes enumerating the shards of the next size
+        self.num_workers = num_workers
+        self.shard_lists = {}
         # Heuristics to avoid redundant formulas
         
         self.spot_containment = spot.language_containment_checker()
+        self.spot_memo = get_spot_memo(atoms)
         self.heuristics = {'syn_eq': True, 
                             'simp_eq': True, 
                             'spot_syn_eq': True,
                             'spot_simp_eq': True,
                             'spot_sem_eq': True,
+                            'comm_eq': True,
                             }
         self.heuristics_functions = {'syn_eq': syntax_heur,
                                      'simp_eq': simplify_heur,
@@ -121,6 +247,8 @@ class GrammarGenPLTL:
         self.heuristics_times = {h: 0 for h in self.heuristics}
         self.total_formula_counter = 0
         self.total_time = 0
+        # rounded probabilities on the examples -> first (smallest) formula seen with them
+        self.fingerprints = {}
 
     def apply_binary_heuristics(self, f1, f2):
         
@@ -143,7 +271,7 @@ class GrammarGenPLTL:
 
         if self.heuristics['spot_sem_eq']:
             t0 = time.time()
-            if self.heuristics_functions['spot_sem_eq'](f1, f2, self.spot_containment):
+            if self.heuristics_functions['spot_sem_eq'](f1, f2, self.spot_containment, self.spot_memo):
                 self.heuristics_counter['spot_sem_eq'] += 1
                 heuristic_succ = True
             t1 = time.time() - t0
@@ -164,14 +292,36 @@ class GrammarGenPLTL:
 
         if self.heuristics['spot_simp_eq']:
             t0 = time.time()
-            if self.heuristics_functions['spot_simp_eq'](f1):
+            if self.heuristics_functions['spot_simp_eq'](f1, self.spot_memo):
                 self.heuristics_counter['spot_simp_eq'] += 1
                 heuristic_succ = True
             t1 = time.time() - t0
             self.heuristics_times['spot_simp_eq'] += t1
 
         return heuristic_succ
-    
+
+    def apply_observational_heuristics(self, key, formulas, results, digits):
+        '''
+        Observational equivalence: removes the formulas of formula_list[key] whose probabilities on all the
+        examples (rounded to the given digits) match those of an already seen formula, so that only the
+        smallest representative is composed into the next sizes. The rows of results follow the formulas.
+        '''
+        t0 = time.time()
+        # adding 0.0 turns -0.0 into 0.0, so that equal rows have equal bytes
+        rounded = np.round(results, digits) + 0.0
+        for formula, row in zip(formulas, rounded):
+            # formulas without results on some models (early abort) cannot be compared
+            if formula not in self.formula_list[key] or np.isnan(row).any():
+                continue
+            fingerprint = row.tobytes()
+            if fingerprint in self.fingerprints:
+                self.formula_list[key].discard(formula)
+                self.heuristics_counter['obs_eq'] += 1
+            else:
+                self.fingerprints[fingerprint] = formula
+        t1 = time.time() - t0
+        self.heuristics_times['obs_eq'] += t1
+
 
     def init_formulas(self):
         
@@ -190,64 +340,274 @@ class GrammarGenPLTL:
 
     def gen_next_size(self):
         '''
-        Grammar generator now creates all possible formulas of size n+1 for all depths
+        Grammar generator now creates all possible formulas of size n+1 for all depths.
+        The (operator, size, depth, f1, f2) space is split into shards of fixed size that are enumerated
+        in a process pool and merged in shard order, so the result does not depend on the number of workers.
         '''
         t0 = time.time()
+        self.add_next_size(self.enumerate_next_size())
+        t1 = time.time() - t0
+        self.total_time += t1
+
+    def enumerate_next_size(self):
+        '''
+        Enumerates the shards of the next size from a snapshot of the current formula lists: returns an
+        iterator of (shard, (formulas, counter, times)) in shard order. The shards are enumerated by a separate
+        grammar (or the process pool), so the iterator can run in another thread while the lists are pruned.
+        '''
+        worker = GrammarGenPLTL(self.atoms, self.max_depth, self.max_size)
+        worker.heuristics = dict(self.heuristics)
+        worker.heuristics_counter = {h: 0 for h in worker.heuristics}
+        worker.heuristics_times = {h: 0 for h in worker.heuristics}
+        worker.spot_memo = self.spot_memo
+        worker.current_size = self.current_size
+        worker.shard_lists = {key: list(formulas) for key, formulas in self.formula_list.items() if key[1] <= self.current_size}
+        return worker.enumerate_shards(self.num_workers)
+
+    def enumerate_shards(self, num_workers):
+
+        shards = self.gen_shards()
+        if num_workers > 1 and len(shards) > 1 and not multiprocessing.current_process().daemon:
+            with ProcessPoolExecutor(max_workers=num_workers, initializer=init_shard_worker,
+                                     initargs=(self.atoms, self.heuristics, self.current_size, self.shard_lists)) as executor:
+                for shard, (formulas, counter, times, computed) in zip(shards, executor.map(run_shard, shards)):
+                    # the spot results of the workers are saved with the memo of this process
+                    self.spot_memo.add_stored(computed)
+                    yield shard, (formulas, counter, times)
+        else:
+            for shard in shards:
+                yield shard, self.gen_shard(shard)
+
+    def add_next_size(self, shard_results, alive=None):
+        '''
+        Adds the enumerated shards as the next size. With the set of alive formulas, the formulas built on a
+        subformula that is not alive anymore (pruned after they were enumerated) are left out, returns their number.
+        '''
         next_size = self.current_size + 1
         for depth in range(self.max_depth+1):
             self.formula_list[(depth,next_size)] = set()
-            
+        dropped = 0
+        for shard, (formulas, counter, times) in shard_results:
+            if alive is not None:
+                kept = [f for f in formulas if f.left in alive and (f.right is None or f.right in alive)]
+                dropped += len(formulas) - len(kept)
+                formulas = kept
+            self.formula_list[(shard[1],next_size)].update(formulas)
+            for h in counter:
+                self.heuristics_counter[h] += counter[h]
+                self.heuristics_times[h] += times[h]
+        for depth in range(self.max_depth+1):
+            self.total_formula_counter += len(self.formula_list[(depth,next_size)])
+
+        self.current_size = next_size
+        return dropped
+
+    def gen_shards(self):
+        '''
+        Shards of the next size as (kind, depth, operator, left key, right key, start, end): the formulas
+        start:end of the left list, combined with all the formulas of the right list
+        '''
+        shards = []
+        def split(kind, depth, op, key1, key2):
+            num_left = len(self.shard_lists.get(key1, []))
+            num_right = len(self.shard_lists.get(key2, [])) if key2 is not None else 1
+            if num_left == 0 or num_right == 0:
+                return
+            step = max(1, SHARD_SIZE // num_right)
+            for start in range(0, num_left, step):
+                shards.append((kind, depth, op, key1, key2, start, min(start+step, num_left)))
+
+        for depth in range(self.max_depth+1):
             if depth != 0:
                 for op in temporal_unary:
-                    for left in self.formula_list[(depth-1,self.current_size)]:
-                        new_formula = LTLFormula([op, left, None])
-                        
-                        if self.apply_unary_heuristics(new_formula):
-                            continue
-                        self.formula_list[(depth,next_size)].add(new_formula)
-
+                    split('unary', depth, op, (depth-1,self.current_size), None)
                 for op in temporal_binary:
                     for size in range(1, self.current_size+1):
                         for d in range(depth):
-                            for f1 in self.formula_list[(d,size)]:
-                                for f2 in self.formula_list[(depth-1,self.current_size - size)]:
-                                    
-                                    #### Heuristics to remove redundant formulas ####
-                                    if self.apply_binary_heuristics(f1, f2):
-                                        continue
-                                    #### End of heuristics ####
-
-                                    new_formula1 = LTLFormula([op, f1, f2])
-                                    new_formula2 = LTLFormula([op, f2, f1])
-                                    
-                                    #### Heuristics to remove redundant formulas ####
-                                    if self.apply_unary_heuristics(new_formula1):
-                                        continue
-                                    if self.apply_unary_heuristics(new_formula2):
-                                        continue
-                                    #### End of heuristics ####
-                                    self.formula_list[(depth,next_size)].add(new_formula1)
-                                    self.formula_list[(depth,next_size)].add(new_formula2)
-
-            #if depth == 0:
+                            split('temporal', depth, op, (d,size), (depth-1,self.current_size - size))
             for op in bool_binary:
                 for size in range(1, self.current_size+1):
                     for d in range(depth+1):
-                        for f1 in self.formula_list[(d,size)]:
-                            for f2 in self.formula_list[(depth,self.current_size - size)]:
+                        split('bool', depth, op, (d,size), (depth,self.current_size - size))
+        return shards
 
-                                if self.apply_binary_heuristics(f1, f2):
-                                    continue
-                                new_formula = LTLFormula([op, f1, f2])
+    def gen_shard(self, shard):
+        '''
+        Enumerates the formulas of a shard, returns them with the heuristics counters and times of the shard
+        '''
+        kind, depth, op, key1, key2, start, end = shard
+        saved_counter, saved_times = self.heuristics_counter, self.heuristics_times
+        self.heuristics_counter = {h: 0 for h in saved_counter}
+        self.heuristics_times = {h: 0 for h in saved_times}
+        new_formulas = []
+        try:
+            if kind == 'unary':
+                for left in self.shard_lists[key1][start:end]:
+                    new_formula = LTLFormula([op, left, None])
+
+                    if self.apply_unary_heuristics(new_formula):
+                        continue
+                    new_formulas.append(new_formula)
+
+            elif kind == 'temporal':
+                for f1 in self.shard_lists[key1][start:end]:
+                    for f2 in self.shard_lists[key2]:
+
+                        #### Heuristics to remove redundant formulas ####
+                        if self.apply_binary_heuristics(f1, f2):
+                            continue
+                        #### End of heuristics ####
 
-                                if self.apply_unary_heuristics(new_formula):
-                                    continue
-                                self.formula_list[(depth,next_size)].add(new_formula)
-            
-            self.total_formula_counter += len(self.formula_list[(depth,next_size)])
-        self.current_size = next_size
-        t1 = time.time() - t0
-        self.total_time += t1
+                        new_formula1 = LTLFormula([op, f1, f2])
+                        new_formula2 = LTLFormula([op, f2, f1])
+
+                        #### Heuristics to remove redundant formulas ####
+                        if self.apply_unary_heuristics(new_formula1):
+                            continue
+                        if self.apply_unary_heuristics(new_formula2):
+                            continue
+                        #### End of heuristics ####
+                        new_formulas.append(new_formula1)
+                        new_formulas.append(new_formula2)
+
+            else:
+                # with both operands from the same depth, f2 op f1 is enumerated as well: & and | are
+                # commutative, only the canonical order (f1 <= f2) is kept
+                symmetric = self.heuristics['comm_eq'] and key1[0] == key2[0]
+                for f1 in self.shard_lists[key1][start:end]:
+                    for f2 in self.shard_lists[key2]:
+
+                        if symmetric:
+                            t0 = time.time()
+                            skip = f2 < f1
+                            self.heuristics_times['comm_eq'] += time.time() - t0
+                            if skip:
+                                self.heuristics_counter['comm_eq'] += 1
+                                continue
+                        if self.apply_binary_heuristics(f1, f2):
+                            continue
+                        new_formula = LTLFormula([op, f1, f2])
+
+                        if self.apply_unary_heuristics(new_formula):
+                            continue
+                        new_formulas.append(new_formula)
+            # duplicates within the shard are not sent back
+            new_formulas = list(dict.fromkeys(new_formulas))
+            return new_formulas, self.heuristics_counter, self.heuristics_times
+        finally:
+            self.heuristics_counter, self.heuristics_times = saved_counter, saved_times
+
+
+# grammar of a shard worker process, holding the formulas of the sizes already enumerated
+shard_grammar = None
+
+def init_shard_worker(atoms, heuristics, current_size, shard_lists):
+    global shard_grammar
+    shard_grammar = GrammarGenPLTL(atoms)
+    shard_grammar.heuristics = heuristics
+    shard_grammar.heuristics_counter = {h: 0 for h in heuristics}
+    shard_grammar.heuristics_times = {h: 0 for h in heuristics}
+    shard_grammar.current_size = current_size
+    shard_grammar.shard_lists = shard_lists
+    shard_grammar.spot_memo.computed = {}
+
+def run_shard(shard):
+    return shard_grammar.gen_shard(shard) + (shard_grammar.spot_memo.take_computed(),)
+
+
+class GrammarPipeline:
+    '''
+    Enumerates the next size of the grammar in a background thread while the current size is model checked.
+    The shards are handed over through a bounded queue, so the enumeration runs at most max_shards shards
+    ahead. They are added once the current size is final: the formulas built on a subformula pruned meanwhile
+    (discard heuristic, observational equivalence) are left out, so the formula lists are the same as with
+    gen_next_size and the sizes are still checked in order.
+    '''
+    def __init__(self, grammar, max_shards=64):
+
+        self.grammar = grammar
+        self.max_shards = max_shards
+        self.shards = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.generation_time = 0
+        # formulas enumerated ahead and left out, time the checks waited for the enumeration
+        self.dropped = 0
+        self.wait_time = 0
+
+    def start(self):
+        '''
+        Starts enumerating the size after grammar.current_size from the current formula lists
+        '''
+        self.shards = queue.Queue(maxsize=self.max_shards)
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.produce, args=(self.grammar.enumerate_next_size(), self.shards), daemon=True)
+        self.thread.start()
+
+    def produce(self, shard_results, shards):
+
+        try:
+            while True:
+                t0 = time.time()
+                item = next(shard_results, None)
+                self.generation_time += time.time() - t0
+                if item is None:
+                    break
+                if not self.put(shards, item):
+                    shard_results.close()
+                    return
+        except Exception as e:
+            self.put(shards, e)
+            return
+        self.put(shards, None)
+
+    def put(self, shards, item):
+
+        while not self.stopped.is_set():
+            try:
+                shards.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def received(self):
+
+        while True:
+            t0 = time.time()
+            item = self.shards.get()
+            self.wait_time += time.time() - t0
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def finish(self):
+        '''
+        Waits for the enumeration of the next size and adds it to the grammar, keeping only the formulas whose
+        subformulas were not pruned
+        '''
+        alive = set()
+        for formulas in self.grammar.formula_list.values():
+            alive.update(formulas)
+        self.dropped += self.grammar.add_next_size(self.received(), alive)
+        self.thread.join()
+        self.thread = None
+        self.grammar.total_time += self.generation_time
+        self.generation_time = 0
+
+    def close(self):
+        '''
+        Stops the enumeration running ahead, if any
+        '''
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def stats(self):
+        return {'pipeline_dropped': self.dropped, 'pipeline_wait': round(self.wait_time, 3)}
 
 
 
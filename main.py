@@ -4,8 +4,9 @@ import json
 import argparse
 import time
 import numpy as np
-from multiprocessing import Pool
-from separator import Separator, find_pltl_formula
+from multiprocessing import Pool, BoundedSemaphore
+from separator import Separator, find_pltl_formula, set_check_budget
+from scheduler import CheckScheduler
 
 
 
@@ -31,12 +32,20 @@ def compile_results(folders):
             f.write(','.join([str(result[key]) for key in keys])+'\n')
 
 
-def multi_process_run_ltl_learning(folders, num_examples, num_processes, prism_binary, atoms, labels):
-    with Pool(processes=num_processes) as pool:
-        args = [(folder, num, prism_binary, atoms, labels) for folder in folders for num in num_examples]
+def multi_process_run_ltl_learning(folders, num_examples, num_processes, prism_binary, atoms, labels, options=None, check_budget=None):
+    args = [(folder, num, prism_binary, atoms, labels, options) for folder in folders for num in num_examples]
+    # all the runs share one budget of concurrent model checks
+    budget = BoundedSemaphore(check_budget or os.cpu_count() or 1)
+    if num_processes == 1:
+        # in-process, so that the runs can start their own worker processes (pool processes cannot)
+        set_check_budget(budget)
+        for arg in args:
+            run_ltl_learning(*arg)
+        return
+    with Pool(processes=num_processes, initializer=set_check_budget, initargs=(budget,)) as pool:
         pool.starmap(run_ltl_learning, args)
 
-def run_ltl_learning(folder, num_examples, prism_binary, atoms, labels):
+def run_ltl_learning(folder, num_examples, prism_binary, atoms, labels, options=None):
 
     # learning parameters
     max_size = 6
@@ -53,7 +62,7 @@ def run_ltl_learning(folder, num_examples, prism_binary, atoms, labels):
 
     info_file = f'learn_info_size_{max_size}_num_{total_examples}'
     
-    find_pltl_formula(prism_binary=prism_binary, atoms=atoms, labels=labels, positive=pos_files, negative=neg_files, max_size=max_size, verbose=False, delta_param=delta, info_file=info_file)
+    find_pltl_formula(prism_binary=prism_binary, atoms=atoms, labels=labels, positive=pos_files, negative=neg_files, max_size=max_size, verbose=False, delta_param=delta, info_file=info_file, **(options or {}))
 
 
 def main():
@@ -64,6 +73,29 @@ def main():
     parser.add_argument('--compile', '-c', action='store_true',default=True)
     parser.add_argument('--run_all', '-a', action='store_true',default=False)
     parser.add_argument('--nailgun', '-ng', action='store_true',default=False)
+    parser.add_argument('--prism_workers', '-w', type=int, default=None)
+    parser.add_argument('--backend', '-b', type=str, default='prism', choices=['prism', 'native'])
+    parser.add_argument('--cache', '-C', type=str, default=None)
+    parser.add_argument('--cache_size', type=int, default=1024)
+    parser.add_argument('--obs_eq', type=int, default=None)
+    parser.add_argument('--spot_memo', type=str, default=None)
+    parser.add_argument('--grammar_workers', '-gw', type=int, default=1)
+    parser.add_argument('--check_budget', type=int, default=None)
+    parser.add_argument('--scheduler', '-s', type=int, default=0)
+    parser.add_argument('--compact', action='store_true', default=False)
+    parser.add_argument('--explicit', action='store_true', default=False)
+    parser.add_argument('--bisim', action='store_true', default=False)
+    parser.add_argument('--smc', type=float, default=None)
+    parser.add_argument('--smc_samples', type=int, default=1000)
+    parser.add_argument('--smc_horizon', type=int, default=100)
+    parser.add_argument('--early_abort', action='store_true', default=False)
+    parser.add_argument('--bsc_policy', type=str, default='lazy', choices=['skip', 'lazy'])
+    parser.add_argument('--coarse', type=float, default=None)
+    parser.add_argument('--incremental', action='store_true', default=False)
+    parser.add_argument('--pipeline', action='store_true', default=False)
+    parser.add_argument('--chunk_size', type=int, default=None)
+    parser.add_argument('--chunk_retries', type=int, default=2)
+    parser.add_argument('--resume', action='store_true', default=False)
 
     # Description of arguments:
     #
@@ -78,10 +110,74 @@ def main():
     # --run_all: whether to run all the experiments (computationally expensive) or just a subset (computatinally feasible)
     #
     # --nailgun: whether to use the nailgun server for PRISM (significantly faster)
-    # Note: for nailgun, you need to activate the nailgun server first, which can be done as follows:
-    # prism -ng &
-    # If your Java version is >=19, you need to set a flag to allow this when you initially start PRISM:
-    # PRISM_JAVA_PARAMS=-Djava.security.manager=allow prism -ng &
+    # Note: the nailgun servers are started, health-checked and stopped by the tool itself (one per PRISM worker),
+    # there is no need to run prism -ng & beforehand. If your Java version is >=19, the flag
+    # PRISM_JAVA_PARAMS=-Djava.security.manager=allow is added automatically when the server fails to start without it.
+    #
+    # --prism_workers: number of PRISM workers of each learning run (default: one per core)
+    #
+    # --backend: the model checker computing the probabilities, allows the following strings:
+    # prism: runs PRISM on every model and property file
+    # native: in-process checking with NumPy/SciPy on the explicit DTMCs and spot automata (no JVM)
+    #
+    # --cache: file of the persistent result cache, shared by all runs and processes (disabled by default)
+    # --cache_size: size bound of the result cache in MB, least recently used results are evicted above it
+    #
+    # --obs_eq: prune formulas with the same probabilities on all examples (rounded to the given number of digits)
+    # as an already enumerated formula, only the smallest one is composed into larger formulas (disabled by default)
+    #
+    # --spot_memo: folder where the spot containment and simplification results are saved, one file per atom set,
+    # so that runs over the same atoms reuse them (by default they are only shared within a process)
+    #
+    # --grammar_workers: number of processes enumerating the formulas of each size (default: 1, in-process)
+    # Note: the enumeration stays in-process when the learning runs themselves are spread over --num_processes > 1
+    #
+    # --check_budget: maximal number of model checks running at once over all the learning runs (default: one per core),
+    # each run checks the models of a batch concurrently on its PRISM workers within this budget
+    #
+    # --scheduler: number of checker processes of a global scheduler shared by all the learning runs (default: 0, disabled)
+    # The runs submit their (model, property batch) checks to a shared queue, identical checks of different runs are
+    # done once, and the progress and throughput are printed every 30 seconds.
+    #
+    # --compact: keep only the probability in the initial state and the minimum/maximum over the states of each
+    # result instead of the whole vector (less parsing, memory and cache space on models with many states)
+    #
+    # --explicit: compile every example model once into an explicit model (PRISM .tra/.sta/.lab files, or a NumPy archive
+    # for the native backend) stored in an explicit_models folder next to the models, and check the formulas on it
+    # instead of building the .pm model for every batch. Entries are rebuilt when the model or the labels change.
+    #
+    # --bisim: before learning, replace every example model by its bisimulation quotient over the atoms (states with
+    # the same atoms and the same probabilities of moving to every class are merged), so that smaller models are checked.
+    # The state counts before and after are reported in the learn_info file.
+    #
+    # --smc: statistical pre-filter with the given false-drop rate (e.g. 0.01): the probabilities of the formulas are
+    # estimated with confidence intervals on --smc_samples sampled paths of --smc_horizon steps per model, and the formulas
+    # that cannot separate the examples by more than delta are not model checked, with --bsc_policy 'lazy' until no formula
+    # of the batch separates the examples (the boolean combinations get them), with 'skip' not at all
+    #
+    # --early_abort: check the models of a batch alternating positives and negatives, and only check the formulas that
+    # can still separate the examples (or be discarded) on the next models. --bsc_policy decides what the boolean
+    # combinations get: 'skip' ignores the aborted formulas, 'lazy' checks them on their remaining models when no formula
+    # of the batch separates the examples
+    #
+    # --coarse: two-tier checking, the batches are checked with interval iteration up to the given absolute error (e.g.
+    # 0.01), and only the formulas whose separation or boolean combination classification could change within that error
+    # are checked again with the default precision
+    #
+    # --incremental: with the native backend, keep the per-state probabilities of the subformulas on every model and compute
+    # the formulas from those of their children when the operator allows it (X, !, F/G/U of state formulas, and/or with a
+    # state formula), the other formulas are checked on the automaton product
+    #
+    # --pipeline: enumerate the next formula size in a background thread while the current size is model checked, the
+    # formulas built on a subformula pruned meanwhile are left out when the size is added
+    #
+    # --chunk_size: check the property files of more than the given number of properties by chunks (e.g. 2000), the results
+    # are merged, a failed chunk is checked again without the completed ones, and the time and peak memory of every chunk
+    # are recorded
+    # --chunk_retries: number of times a failed chunk is checked again before the run fails
+    #
+    # --resume: continue the interrupted learning runs from their checkpoint (saved after every size and depth), the runs
+    # already complete are skipped
 
     args = parser.parse_args()
     experiment = args.experiment
@@ -89,12 +185,38 @@ def main():
     compile = args.compile
     run_all = args.run_all
     nailgun = args.nailgun
+    prism_workers = args.prism_workers
+    backend = args.backend
+    cache_file = args.cache
+    cache_size = args.cache_size
+    obs_eq = args.obs_eq
+    spot_memo_dir = args.spot_memo
+    grammar_workers = args.grammar_workers
+    check_budget = args.check_budget
+    num_checkers = args.scheduler
+    compact = args.compact
+    explicit_models = args.explicit
+    bisimulation = args.bisim
+    smc_alpha = args.smc
+    smc_samples = args.smc_samples
+    smc_horizon = args.smc_horizon
+    early_abort = args.early_abort
+    bsc_policy = args.bsc_policy
+    precision = args.coarse
+    incremental = args.incremental
+    pipeline = args.pipeline
+    chunk_size = args.chunk_size
+    chunk_retries = args.chunk_retries
+    resume = args.resume
 
 
-    if nailgun:
-        prism_binary = 'ngprism'
-    else:
-        prism_binary = 'prism'
+    prism_binary = 'prism'
+    # additional keyword arguments of find_pltl_formula
+    options = {'nailgun': nailgun, 'num_workers': prism_workers, 'backend': backend, 'cache_file': cache_file, 'cache_size': cache_size, 'obs_eq': obs_eq, 'spot_memo_dir': spot_memo_dir, 'grammar_workers': grammar_workers, 'compact': compact, 'explicit_models': explicit_models, 'bisimulation': bisimulation, 'smc_alpha': smc_alpha, 'smc_samples': smc_samples, 'smc_horizon': smc_horizon, 'early_abort': early_abort, 'bsc_policy': bsc_policy, 'precision': precision, 'incremental': incremental, 'pipeline': pipeline, 'chunk_size': chunk_size, 'chunk_retries': chunk_retries, 'resume': resume}
+    scheduler = None
+    if num_checkers > 0:
+        scheduler = CheckScheduler(num_checkers, prism_binary=prism_binary, nailgun=nailgun, backend=backend, incremental=incremental)
+        options['scheduler'] = scheduler.client()
     
     if experiment == 'diff_tasks':
         atoms = ['"a"', '"b"', '"h"']
@@ -102,11 +224,11 @@ def main():
         if run_all:
             folders = [f'final_experiments/Strategies/application1/taskset{i}' for i in range(1, 6)]
             num_examples = [5,10]
-            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels)
+            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels, options=options, check_budget=check_budget)
         else:
             folders = [f'final_experiments/Strategies/application1/taskset{i}' for i in range(1, 4)]
             num_examples = [10]
-            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels)
+            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels, options=options, check_budget=check_budget)
 
     
     elif experiment == 'same_task':
@@ -115,11 +237,11 @@ def main():
         if run_all:
             folders = [f'final_experiments/Strategies/application2/formula{i}' for i in range(1, 5)]
             num_examples = [5,10,15,20,25,30]
-            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels)
+            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels, options=options, check_budget=check_budget)
         else:
             folders = [f'final_experiments/Strategies/application2/formula{i}' for i in range(1, 4)]
             num_examples = [10,15]
-            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels)
+            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels, options=options, check_budget=check_budget)
 
     elif experiment == 'variants':
         
@@ -142,14 +264,19 @@ def main():
         if run_all:
             folders = [f'final_experiments/ModelVariants/EGLP{i}' for i in range(1,8)]
             num_examples = [1]
-            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels)
+            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels, options=options, check_budget=check_budget)
         else:
             folders = [f'final_experiments/ModelVariants/EGLP{i}' for i in range(1,4)]
             num_examples = [1]
-            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels)
+            multi_process_run_ltl_learning(folders, num_examples, num_processes=num_processes, prism_binary=prism_binary, atoms=atoms, labels=labels, options=options, check_budget=check_budget)
     else:
         print('Invalid experiment type')
+        if scheduler is not None:
+            scheduler.close()
         return
+
+    if scheduler is not None:
+        scheduler.close()
     
     if compile:
         compile_results(folders)
@@ -0,0 +1,188 @@
+import fcntl
+import hashlib
+import os
+import re
+import threading
+from contextlib import contextmanager
+import numpy as np
+from scipy import sparse
+from prism_model import PrismModel, DTMC
+
+
+LABEL_REGEX = re.compile(r'(\d+)="([^"]*)"')
+
+
+def read_labels(lab_file):
+    '''
+    Reads a PRISM label file: returns the label names and, for every state, the names of its labels
+    '''
+    with open(lab_file, 'r') as f:
+        names = dict(LABEL_REGEX.findall(f.readline()))
+        state_labels = {}
+        for line in f:
+            if ':' in line:
+                state, indices = line.split(':')
+                state_labels[int(state)] = [names[i] for i in indices.split()]
+    return list(names.values()), state_labels
+
+
+def merge_labels(lab_files, merged_file):
+    '''
+    Merges PRISM label files (e.g. the model and the property labels) into one
+    '''
+    names = []
+    state_labels = {}
+    for lab_file in lab_files:
+        file_names, file_state_labels = read_labels(lab_file)
+        names += [name for name in file_names if name not in names]
+        for state, labels in file_state_labels.items():
+            state_labels.setdefault(state, []).extend(labels)
+    index = {name: i for i, name in enumerate(names)}
+    with open(merged_file, 'w') as f:
+        f.write(' '.join(f'{i}="{name}"' for i, name in enumerate(names)) + '\n')
+        for state in sorted(state_labels):
+            f.write(f'{state}: ' + ' '.join(str(i) for i in sorted({index[name] for name in state_labels[state]})) + '\n')
+
+
+class ModelStore:
+    '''
+    Cache of the example models compiled once into an explicit representation, kept in a folder next to
+    the models: PRISM transition/state/label files (imported by PRISM instead of building the .pm model
+    again) or a NumPy archive of the DTMC for the native backend. Entries are named after the hash of the
+    model contents and the label definitions, so they are rebuilt when either changes. Entries in use are
+    locked (shared file lock), so that another run does not remove them as stale meanwhile.
+    '''
+    def __init__(self, subfolder='explicit_models'):
+
+        self.subfolder = subfolder
+        self.lock = threading.Lock()
+        self.base_locks = {}
+        # hash of the contents of every model by (path, modification time, size), so a model is read once
+        self.model_hashes = {}
+        self.exported = 0
+        self.reused = 0
+
+    def model_hash(self, pm_file):
+
+        stat = os.stat(pm_file)
+        key = (os.path.abspath(pm_file), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self.model_hashes.get(key)
+        if digest is None:
+            with open(pm_file, 'rb') as f:
+                digest = hashlib.sha256(f.read() + b'\n')
+            with self.lock:
+                self.model_hashes[key] = digest
+        return digest.copy()
+
+    def base(self, pm_file, labels):
+        '''
+        Path of the entry of a model without extension
+        '''
+        digest = self.model_hash(pm_file)
+        digest.update(labels.encode())
+        key = digest.hexdigest()[:16]
+        folder = os.path.join(os.path.dirname(os.path.abspath(pm_file)), self.subfolder)
+        os.makedirs(folder, exist_ok=True)
+        name = os.path.splitext(os.path.basename(pm_file))[0]
+        return os.path.join(folder, f'{name}-{key}')
+
+    def base_lock(self, base):
+        with self.lock:
+            return self.base_locks.setdefault(base, threading.Lock())
+
+    @contextmanager
+    def using(self, base):
+        '''
+        Shared lock of an entry while it is built or read (e.g. imported by PRISM)
+        '''
+        with open(base + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            yield base
+
+    def remove_stale(self, base):
+        '''
+        Removes the entries of older versions of the model or of the labels, except those in use by another run
+        '''
+        folder, current = os.path.split(base)
+        name, key = current.rsplit('-', 1)
+        entry = re.compile(re.escape(name) + r'-([0-9a-f]{16})\.')
+        stale = {}
+        for file in os.listdir(folder):
+            match = entry.match(file)
+            if match and match.group(1) != key and not file.endswith('.lock'):
+                stale.setdefault(match.group(1), []).append(file)
+        for stale_key, files in stale.items():
+            with open(os.path.join(folder, f'{name}-{stale_key}.lock'), 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                for file in files:
+                    if os.path.exists(os.path.join(folder, file)):
+                        os.remove(os.path.join(folder, file))
+
+    def prism_model(self, pm_file, labels, pool):
+        '''
+        Exports the model with PRISM once, returns the path of its .tra/.sta/.lab files without extension,
+        or None if the export failed. The files are to be read within using(base).
+        '''
+        base = self.base(pm_file, labels)
+        with self.base_lock(base):
+            if all(os.path.exists(base + ext) for ext in ['.tra', '.sta', '.lab']):
+                self.reused += 1
+                return base
+
+            temp = f'{base}.{os.getpid()}'
+            with open(temp + '.props', 'w') as f:
+                f.write(labels)
+            pool.run([os.path.abspath(pm_file), temp + '.props', '-exporttrans', temp + '.tra', '-exportstates', temp + '.sta',
+                      '-exportlabels', temp + '.lab', '-exportproplabels', temp + '.plab'])
+            exported = all(os.path.exists(temp + ext) for ext in ['.tra', '.sta', '.lab'])
+            if exported:
+                lab_files = [temp + '.lab'] + ([temp + '.plab'] if os.path.exists(temp + '.plab') else [])
+                merge_labels(lab_files, temp + '.merged')
+                self.remove_stale(base)
+                os.replace(temp + '.tra', base + '.tra')
+                os.replace(temp + '.sta', base + '.sta')
+                os.replace(temp + '.merged', base + '.lab')
+                self.exported += 1
+            else:
+                print(f'Could not export {pm_file}, PRISM builds it for every check')
+            for ext in ['.props', '.tra', '.sta', '.lab', '.plab']:
+                if os.path.exists(temp + ext):
+                    os.remove(temp + ext)
+            return base if exported else None
+
+    def native_model(self, pm_file, labels):
+        '''
+        Loads the DTMC of the model with the labels evaluated, building and saving it the first time
+        '''
+        base = self.base(pm_file, labels)
+        with self.using(base), self.base_lock(base):
+            if os.path.exists(base + '.npz'):
+                self.reused += 1
+                with np.load(base + '.npz') as archive:
+                    transitions = sparse.csr_matrix((archive['data'], archive['indices'], archive['indptr']), shape=tuple(archive['shape']))
+                    dtmc = DTMC(None, archive['states'], transitions, int(archive['initial']))
+                    for key in archive.files:
+                        if key.startswith('label:'):
+                            dtmc.labels[key[len('label:'):]] = archive[key]
+                return dtmc
+
+            dtmc = PrismModel.from_file(pm_file).build()
+            if labels:
+                dtmc.add_labels(labels)
+            transitions = dtmc.transitions.tocsr()
+            arrays = {'data': transitions.data, 'indices': transitions.indices, 'indptr': transitions.indptr,
+                      'shape': np.array(transitions.shape), 'states': np.array(dtmc.states), 'initial': np.array(dtmc.initial)}
+            arrays.update({'label:' + name: values for name, values in dtmc.labels.items()})
+            temp = f'{base}.{os.getpid()}.npz'
+            np.savez(temp, **arrays)
+            self.remove_stale(base)
+            os.replace(temp, base + '.npz')
+            self.exported += 1
+            return dtmc
+
+    def stats(self):
+        return {'explicit_models_exported': self.exported, 'explicit_models_reused': self.reused}
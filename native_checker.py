@@ -0,0 +1,323 @@
+import re
+import threading
+from collections import OrderedDict
+import numpy as np
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse.linalg import spsolve
+import spot
+import buddy
+from prob_logics import LTLFormula, temporal_unary, temporal_binary
+from prism_model import PrismModel
+
+
+PROPERTY_REGEX = re.compile(r'^P\s*(=\?|[<>]=?)\s*([0-9.eE+-]*)\s*\[(.*)\]$')
+COMPARISONS = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal}
+
+
+def read_property_file(tl_file):
+    '''
+    Splits a property file into its label definitions and its properties
+    '''
+    labels = ''
+    properties = []
+    with open(tl_file, 'r') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            if line.startswith('label'):
+                labels += line
+            else:
+                properties.append(line.strip())
+    return labels, properties
+
+
+def backward_reachable(transitions, states):
+    '''
+    States from which the given set of states is reachable in the graph of the transition matrix
+    '''
+    reached = states.copy()
+    frontier = states
+    while frontier.any():
+        frontier = (transitions @ frontier.astype(np.float64) > 0) & ~reached
+        reached |= frontier
+    return reached
+
+
+def reachability_probabilities(transitions, target, epsilon=None, max_iterations=1000000):
+    '''
+    Probability of eventually reaching the target states from every state, with exact 0/1 values for
+    the states found by graph analysis (as PRISM's prob0/prob1 precomputation does). With an epsilon,
+    the other states are computed by interval iteration up to that absolute error instead of exactly.
+    '''
+    # paths stop at the first target state
+    transitions = sparse.diags((~target).astype(np.float64)) @ transitions
+    no = ~backward_reachable(transitions, target)
+    yes = ~backward_reachable(transitions, no)
+    unknown = ~(no | yes)
+    probs = yes.astype(np.float64)
+    if unknown.any():
+        restricted = transitions[unknown]
+        a = sparse.identity(int(unknown.sum()), format='csc') - restricted[:, unknown].tocsc()
+        b = np.asarray(restricted[:, yes].sum(axis=1)).ravel()
+        if epsilon is None:
+            probs[unknown] = np.atleast_1d(spsolve(a, b))
+        else:
+            # value iteration from below and from above, both converge since no bottom SCC is left among
+            # the unknown states; the midpoint is within epsilon/2 of the probabilities
+            step = restricted[:, unknown].tocsr()
+            lower, upper = np.zeros(len(b)), np.ones(len(b))
+            for _ in range(max_iterations):
+                if np.max(upper - lower) <= epsilon:
+                    break
+                lower = step @ lower + b
+                upper = np.minimum(step @ upper + b, 1)
+            probs[unknown] = (lower + upper) / 2
+    return probs
+
+
+class Automaton:
+    '''
+    Deterministic (parity) automaton of an LTL formula built by spot, tabulated by letter: the letter of
+    a valuation is the bitmask of its true atomic propositions
+    '''
+    def __init__(self, spot_formula):
+
+        aut = spot.translate(spot_formula, 'parity', 'deterministic', 'complete')
+        self.aps = [str(ap.ap_name()) for ap in aut.ap()]
+        self.num_states = aut.num_states()
+        self.initial = aut.get_init_state_number()
+        self.acceptance = aut.acc()
+        self.accepting_marks = {}
+
+        num_letters = 2 ** len(self.aps)
+        variables = [aut.register_ap(ap) for ap in aut.ap()]
+        letter_conditions = []
+        for letter in range(num_letters):
+            cond = buddy.bddtrue
+            for i, var in enumerate(variables):
+                cond &= buddy.bdd_ithvar(var) if (letter >> i) & 1 else buddy.bdd_nithvar(var)
+            letter_conditions.append(cond)
+
+        self.successor = np.zeros((self.num_states, num_letters), dtype=np.int64)
+        self.marks = np.zeros((self.num_states, num_letters), dtype=np.int64)
+        for q in range(self.num_states):
+            for edge in aut.out(q):
+                mark = sum(1 << i for i in edge.acc.sets())
+                for letter, cond in enumerate(letter_conditions):
+                    if (edge.cond & cond) != buddy.bddfalse:
+                        self.successor[q, letter] = edge.dst
+                        self.marks[q, letter] = mark
+
+    def accepting(self, marks):
+        '''
+        Whether a run that sees exactly the given acceptance marks infinitely often is accepting
+        '''
+        if marks not in self.accepting_marks:
+            sets = [i for i in range(marks.bit_length()) if (marks >> i) & 1]
+            self.accepting_marks[marks] = self.acceptance.accepting(spot.mark_t(sets))
+        return self.accepting_marks[marks]
+
+
+def ltl_probabilities(dtmc, automaton, epsilon=None):
+    '''
+    Probability of satisfying the automaton's formula from every state of the DTMC, computed on the
+    product DTMC x automaton: reachability of its accepting bottom SCCs
+    '''
+    letters = np.zeros(dtmc.num_states, dtype=np.int64)
+    for i, ap in enumerate(automaton.aps):
+        if ap not in dtmc.labels:
+            raise ValueError(f'Unknown label "{ap}" in the model')
+        letters |= dtmc.labels[ap].astype(np.int64) << i
+
+    n, m = dtmc.num_states, automaton.num_states
+    transitions = dtmc.transitions.tocoo()
+    automaton_states = np.arange(m)
+
+    # the product state (s, q) has index s*m + q, the automaton reads the label of the target state
+    rows = (transitions.row[:, None] * m + automaton_states[None, :]).ravel()
+    succ_letters = letters[transitions.col][:, None]
+    cols = (transitions.col[:, None] * m + automaton.successor[automaton_states[None, :], succ_letters]).ravel()
+    marks = automaton.marks[automaton_states[None, :], succ_letters].ravel()
+    product = sparse.csr_matrix((np.repeat(transitions.data, m), (rows, cols)), shape=(n * m, n * m))
+
+    # accepting bottom SCCs: all their edges are taken infinitely often
+    num_sccs, scc = csgraph.connected_components(product, directed=True, connection='strong')
+    internal = scc[rows] == scc[cols]
+    bottom = np.ones(num_sccs, dtype=bool)
+    bottom[scc[rows[~internal]]] = False
+    scc_marks = np.zeros(num_sccs, dtype=np.int64)
+    np.bitwise_or.at(scc_marks, scc[rows[internal]], marks[internal])
+    accepting = np.array([bottom[k] and automaton.accepting(int(scc_marks[k])) for k in range(num_sccs)], dtype=bool)
+
+    probs = reachability_probabilities(product, accepting[scc], epsilon)
+    initial_states = np.arange(n) * m + automaton.successor[automaton.initial, letters]
+    return probs[initial_states]
+
+
+def propositional(formula):
+    '''
+    Whether the formula is a state formula (a boolean combination of atoms)
+    '''
+    if formula.left is None:
+        return True
+    if formula.label in temporal_unary + temporal_binary:
+        return False
+    return propositional(formula.left) and (formula.right is None or propositional(formula.right))
+
+
+def next_probabilities(transitions, probs):
+    '''
+    Probability of X phi from the probabilities of phi, with exact 0/1 values when all the successors agree
+    '''
+    support = transitions.copy()
+    support.data = np.ones_like(support.data)
+    result = transitions @ probs
+    result[support @ (probs != 1).astype(np.float64) == 0] = 1
+    result[support @ (probs != 0).astype(np.float64) == 0] = 0
+    return result
+
+
+class NativeChecker:
+    '''
+    In-process model checker for the P=? [ LTL ] properties of the pipeline, a drop-in replacement for
+    running PRISM: returns the same per-state vectors as Separator.parse_prism_output
+    '''
+    def __init__(self, model_store=None, incremental=False, vector_cache_size=256):
+        self.model_store = model_store
+        self.models = {}
+        self.model_labels = {}
+        self.automata = {}
+        self.formulas = {}
+        # incremental evaluation: the vectors of the subformulas are kept (up to vector_cache_size MB, least
+        # recently used first out) and combined, only formulas that need it go through the automaton product
+        self.incremental = incremental
+        self.vectors = OrderedDict()
+        self.vector_bytes = 0
+        self.max_vector_bytes = vector_cache_size * 1024 * 1024
+        self.vector_lock = threading.Lock()
+        self.incremental_evaluations = 0
+        self.automaton_evaluations = 0
+
+    def load_model(self, pm_file, labels=''):
+        '''
+        Parses and builds the DTMC of a model file once, and adds the label definitions of the property file
+        '''
+        if self.model_store is not None:
+            # compiled models come with their labels
+            if (pm_file, labels) not in self.models:
+                self.models[(pm_file, labels)] = self.model_store.native_model(pm_file, labels)
+            return self.models[(pm_file, labels)]
+        if pm_file not in self.models:
+            self.models[pm_file] = PrismModel.from_file(pm_file).build()
+            self.model_labels[pm_file] = set()
+        dtmc = self.models[pm_file]
+        if labels and labels not in self.model_labels[pm_file]:
+            dtmc.add_labels(labels)
+            self.model_labels[pm_file].add(labels)
+        return dtmc
+
+    def parse_property(self, prop):
+
+        if prop not in self.formulas:
+            match = PROPERTY_REGEX.match(prop)
+            if match is None:
+                raise ValueError(f'Unsupported property {prop}')
+            formula = LTLFormula.convertPrettyToFormula(match.group(3))
+            self.formulas[prop] = (match.group(1), match.group(2), formula)
+        return self.formulas[prop]
+
+    def probabilities(self, dtmc, formula, epsilon=None):
+
+        if self.incremental:
+            return self.evaluate(dtmc, formula, epsilon)
+        return self.automaton_probabilities(dtmc, formula, epsilon)
+
+    def automaton_probabilities(self, dtmc, formula, epsilon=None):
+
+        key = str(formula.spot_formula)
+        if key not in self.automata:
+            self.automata[key] = Automaton(formula.spot_formula)
+        self.automaton_evaluations += 1
+        return ltl_probabilities(dtmc, self.automata[key], epsilon)
+
+    def evaluate(self, dtmc, formula, epsilon=None):
+        '''
+        Probabilities of the formula from the cached vectors of its subformulas: the state formulas are 0/1
+        vectors, X is a matrix-vector product and ! a complement, a conjunction or disjunction with a state
+        formula is a pointwise product, F, G and U of state formulas are reachability probabilities. The
+        other formulas are checked on the automaton product.
+        '''
+        key = (id(dtmc), formula, epsilon)
+        with self.vector_lock:
+            if key in self.vectors:
+                self.vectors.move_to_end(key)
+                return self.vectors[key]
+
+        label = formula.label
+        transitions = dtmc.transitions
+        left = formula.left
+        right = formula.right
+        if left is None:
+            name = label[1:] if label.startswith('!') else label
+            if not (name.startswith('"') and name.endswith('"')) or name[1:-1] not in dtmc.labels:
+                probs = None
+            else:
+                probs = dtmc.labels[name[1:-1]].astype(np.float64)
+                if label.startswith('!'):
+                    probs = 1 - probs
+        elif label == '!':
+            probs = 1 - self.evaluate(dtmc, left, epsilon)
+        elif label == 'X':
+            probs = next_probabilities(transitions, self.evaluate(dtmc, left, epsilon))
+        elif label in ['&', '|'] and (propositional(left) or propositional(right)):
+            state, path = (left, right) if propositional(left) else (right, left)
+            state_probs = self.evaluate(dtmc, state, epsilon)
+            path_probs = self.evaluate(dtmc, path, epsilon)
+            if label == '&':
+                probs = state_probs * path_probs
+            else:
+                probs = state_probs + (1 - state_probs) * path_probs
+        elif label == 'F' and propositional(left):
+            probs = reachability_probabilities(transitions, self.evaluate(dtmc, left, epsilon) == 1, epsilon)
+        elif label == 'G' and propositional(left):
+            probs = 1 - reachability_probabilities(transitions, self.evaluate(dtmc, left, epsilon) == 0, epsilon)
+        elif label == 'U' and propositional(left) and propositional(right):
+            target = self.evaluate(dtmc, right, epsilon) == 1
+            # paths leaving the left operand before reaching the right one fail
+            allowed = (self.evaluate(dtmc, left, epsilon) == 1) | target
+            probs = reachability_probabilities(sparse.diags(allowed.astype(np.float64)) @ transitions, target, epsilon)
+        else:
+            probs = None
+        if probs is None:
+            probs = self.automaton_probabilities(dtmc, formula, epsilon)
+        else:
+            self.incremental_evaluations += 1
+
+        with self.vector_lock:
+            if key not in self.vectors:
+                self.vectors[key] = probs
+                self.vector_bytes += probs.nbytes
+            while self.vector_bytes > self.max_vector_bytes and len(self.vectors) > 1:
+                _, evicted = self.vectors.popitem(last=False)
+                self.vector_bytes -= evicted.nbytes
+        return probs
+
+    def check(self, pm_file, tl_file, compact=False, epsilon=None):
+        '''
+        Checks all properties of a property file on a model. In compact mode, the result of a property is
+        [value in the first state, minimum, maximum] instead of the whole vector. With an epsilon, the
+        probabilities are computed up to that absolute error.
+        '''
+        labels, properties = read_property_file(tl_file)
+        dtmc = self.load_model(pm_file, labels)
+        output_dict = {}
+        for prop in properties:
+            relation, threshold, formula = self.parse_property(prop)
+            probs = self.probabilities(dtmc, formula, epsilon)
+            if relation != '=?':
+                probs = COMPARISONS[relation](probs, float(threshold))
+            if compact:
+                probs = np.array([probs[0], probs.min(), probs.max()])
+            output_dict['P' + relation + threshold + ' [ ' + formula.prismPrint() + ' ]'] = probs
+        return output_dict
@@ -0,0 +1,502 @@
+import re
+import math
+import itertools
+import numpy as np
+from scipy import sparse
+
+
+TOKEN_REGEX = re.compile(r'''
+      (?P<skip>\s+|//[^\n]*)
+    | (?P<number>\d+\.\d+(?:[eE][-+]?\d+)?|\d+(?:[eE][-+]?\d+)?)
+    | (?P<string>"[^"]*")
+    | (?P<ident>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<op><=>|=>|->|<=|>=|!=|\.\.|[-+*/&|!=<>?:;,\[\]()'{}])
+''', re.VERBOSE)
+
+MODEL_TYPES = ['dtmc', 'probabilistic']
+UNSUPPORTED_MODEL_TYPES = ['mdp', 'ctmc', 'nondeterministic', 'stochastic', 'pta', 'popomdp', 'pomdp', 'smg', 'csg']
+RELATIONAL_OPS = ['=', '!=', '<', '<=', '>', '>=']
+PYTHON_OPS = {'&': 'and', '|': 'or', '=': '==', '!=': '!=', '<': '<', '<=': '<=', '>': '>', '>=': '>=',
+              '+': '+', '-': '-', '*': '*', '/': '/'}
+
+
+def tokenize(text):
+    '''
+    Splits PRISM source text into (kind, value) tokens
+    '''
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = TOKEN_REGEX.match(text, pos)
+        if match is None:
+            raise ValueError(f'Unexpected character {text[pos]!r} in PRISM model')
+        pos = match.end()
+        kind = match.lastgroup
+        if kind != 'skip':
+            tokens.append((kind, match.group(kind)))
+    return tokens
+
+
+class PrismParser:
+    '''
+    Recursive descent parser for the DTMC fragment of the PRISM language used by the experiments:
+    constants, formulas, labels, global variables, modules (also by renaming), synchronising commands
+    '''
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset][1]
+        return None
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, token = self.next()
+        if token != value:
+            raise ValueError(f'Expected {value!r} but found {token!r} in PRISM model')
+        return token
+
+    def identifier(self):
+        kind, token = self.next()
+        if kind != 'ident':
+            raise ValueError(f'Expected an identifier but found {token!r} in PRISM model')
+        return token
+
+    ## Expressions, parsed into nested tuples ##
+
+    def expression(self):
+        cond = self.implies()
+        if self.peek() == '?':
+            self.next()
+            then_expr = self.expression()
+            self.expect(':')
+            else_expr = self.expression()
+            return ('ite', cond, then_expr, else_expr)
+        return cond
+
+    def implies(self):
+        left = self.iff()
+        if self.peek() == '=>':
+            self.next()
+            return ('bin', '=>', left, self.implies())
+        return left
+
+    def iff(self):
+        left = self.disjunction()
+        while self.peek() == '<=>':
+            self.next()
+            left = ('bin', '<=>', left, self.disjunction())
+        return left
+
+    def disjunction(self):
+        left = self.conjunction()
+        while self.peek() == '|':
+            self.next()
+            left = ('bin', '|', left, self.conjunction())
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.peek() == '&':
+            self.next()
+            left = ('bin', '&', left, self.negation())
+        return left
+
+    def negation(self):
+        if self.peek() == '!':
+            self.next()
+            return ('un', '!', self.negation())
+        return self.relation()
+
+    def relation(self):
+        left = self.additive()
+        if self.peek() in RELATIONAL_OPS:
+            op = self.next()[1]
+            return ('bin', op, left, self.additive())
+        return left
+
+    def additive(self):
+        left = self.multiplicative()
+        while self.peek() in ['+', '-']:
+            op = self.next()[1]
+            left = ('bin', op, left, self.multiplicative())
+        return left
+
+    def multiplicative(self):
+        left = self.unary()
+        while self.peek() in ['*', '/']:
+            op = self.next()[1]
+            left = ('bin', op, left, self.unary())
+        return left
+
+    def unary(self):
+        if self.peek() == '-':
+            self.next()
+            return ('un', '-', self.unary())
+        return self.primary()
+
+    def primary(self):
+        kind, token = self.next()
+        if kind == 'number':
+            return ('num', float(token) if ('.' in token or 'e' in token.lower()) else int(token))
+        if token in ['true', 'false']:
+            return ('num', token == 'true')
+        if token == '(':
+            expr = self.expression()
+            self.expect(')')
+            return expr
+        if kind == 'ident':
+            if self.peek() == '(':
+                self.next()
+                args = [self.expression()]
+                while self.peek() == ',':
+                    self.next()
+                    args.append(self.expression())
+                self.expect(')')
+                return ('call', token, args)
+            return ('id', token)
+        raise ValueError(f'Unexpected token {token!r} in PRISM expression')
+
+    ## Model structure ##
+
+    def variable(self):
+        name = self.identifier()
+        self.expect(':')
+        if self.peek() == 'bool':
+            self.next()
+            var_range = None
+        else:
+            self.expect('[')
+            low = self.expression()
+            self.expect('..')
+            high = self.expression()
+            self.expect(']')
+            var_range = (low, high)
+        init = None
+        if self.peek() == 'init':
+            self.next()
+            init = self.expression()
+        self.expect(';')
+        return (name, var_range, init)
+
+    def command(self):
+        self.expect('[')
+        action = None
+        if self.peek() != ']':
+            action = self.identifier()
+        self.expect(']')
+        guard = self.expression()
+        self.expect('->')
+        updates = [self.update()]
+        while self.peek() == '+':
+            self.next()
+            updates.append(self.update())
+        self.expect(';')
+        return (action, guard, updates)
+
+    def update(self):
+        prob = ('num', 1)
+        if not self.is_assignment() and not (self.peek() == 'true' and self.peek(1) in [';', '+']):
+            prob = self.expression()
+            self.expect(':')
+        assignments = []
+        if self.peek() == 'true':
+            self.next()
+            return (prob, assignments)
+        assignments.append(self.assignment())
+        while self.peek() == '&':
+            self.next()
+            assignments.append(self.assignment())
+        return (prob, assignments)
+
+    def is_assignment(self):
+        return self.peek() == '(' and self.peek(2) == "'"
+
+    def assignment(self):
+        self.expect('(')
+        name = self.identifier()
+        self.expect("'")
+        self.expect('=')
+        expr = self.expression()
+        self.expect(')')
+        return (name, expr)
+
+    def module_body(self):
+        variables = []
+        commands = []
+        while self.peek() != 'endmodule':
+            if self.peek() == '[':
+                commands.append(self.command())
+            else:
+                variables.append(self.variable())
+        self.expect('endmodule')
+        return variables, commands
+
+    def label(self):
+        kind, name = self.next()
+        if kind != 'string':
+            raise ValueError(f'Expected a label name but found {name!r} in PRISM model')
+        self.expect('=')
+        expr = self.expression()
+        self.expect(';')
+        return name[1:-1], expr
+
+    def labels(self):
+        '''
+        Parses a sequence of label definitions (as written at the top of the property files)
+        '''
+        labels = []
+        while self.pos < len(self.tokens):
+            self.expect('label')
+            labels.append(self.label())
+        return labels
+
+    def model(self):
+
+        model = PrismModel()
+        module_tokens = {}
+        while self.pos < len(self.tokens):
+            token = self.peek()
+            if token in MODEL_TYPES:
+                self.next()
+            elif token in UNSUPPORTED_MODEL_TYPES:
+                raise ValueError(f'Only DTMCs are supported by the native backend, found {token}')
+            elif token == 'const':
+                self.next()
+                if self.peek() in ['int', 'double', 'bool']:
+                    self.next()
+                name = self.identifier()
+                if self.peek() != '=':
+                    raise ValueError(f'Undefined constant {name} in PRISM model')
+                self.next()
+                model.constants.append((name, self.expression()))
+                self.expect(';')
+            elif token == 'formula':
+                self.next()
+                name = self.identifier()
+                self.expect('=')
+                model.formulas[name] = self.expression()
+                self.expect(';')
+            elif token == 'label':
+                self.next()
+                model.labels.append(self.label())
+            elif token == 'global':
+                self.next()
+                model.variables.append(self.variable())
+            elif token == 'module':
+                self.next()
+                name = self.identifier()
+                if self.peek() == '=':
+                    # module renaming: re-parse the body of the original module with substituted identifiers
+                    self.next()
+                    base = self.identifier()
+                    self.expect('[')
+                    renaming = {}
+                    while True:
+                        old = self.identifier()
+                        self.expect('=')
+                        renaming[old] = self.identifier()
+                        if self.peek() != ',':
+                            break
+                        self.next()
+                    self.expect(']')
+                    self.expect('endmodule')
+                    tokens = [(kind, renaming.get(value, value)) if kind == 'ident' else (kind, value) for kind, value in module_tokens[base]]
+                    variables, commands = PrismParser(tokens).module_body()
+                else:
+                    start = self.pos
+                    variables, commands = self.module_body()
+                    module_tokens[name] = self.tokens[start:self.pos]
+                model.variables += variables
+                model.modules.append((name, commands))
+            elif token == 'rewards':
+                while self.next()[1] != 'endrewards':
+                    pass
+            else:
+                raise ValueError(f'Unsupported PRISM construct {token!r}')
+        return model
+
+
+class PrismModel:
+    '''
+    A parsed PRISM DTMC, able to build its explicit state space
+    '''
+    def __init__(self):
+        self.constants = []
+        self.formulas = {}
+        self.labels = []
+        self.variables = []
+        self.modules = []
+        self.values = {}
+        self.var_index = {}
+
+    @classmethod
+    def from_file(cls, pm_file):
+        with open(pm_file, 'r') as f:
+            return PrismParser(tokenize(f.read())).model()
+
+    def compile(self, expr):
+        '''
+        Translates an expression into Python source over the state tuple s
+        '''
+        kind = expr[0]
+        if kind == 'num':
+            return repr(expr[1])
+        if kind == 'id':
+            name = expr[1]
+            if name in self.var_index:
+                return f's[{self.var_index[name]}]'
+            if name in self.values:
+                return repr(self.values[name])
+            if name in self.formulas:
+                return '(' + self.compile(self.formulas[name]) + ')'
+            raise ValueError(f'Unknown identifier {name} in PRISM model')
+        if kind == 'un':
+            if expr[1] == '!':
+                return f'(not {self.compile(expr[2])})'
+            return f'(-{self.compile(expr[2])})'
+        if kind == 'bin':
+            op, left, right = expr[1], self.compile(expr[2]), self.compile(expr[3])
+            if op == '=>':
+                return f'((not {left}) or {right})'
+            if op == '<=>':
+                return f'(bool({left}) == bool({right}))'
+            return f'({left} {PYTHON_OPS[op]} {right})'
+        if kind == 'ite':
+            return f'({self.compile(expr[2])} if {self.compile(expr[1])} else {self.compile(expr[3])})'
+        if kind == 'call':
+            name, args = expr[1], [self.compile(arg) for arg in expr[2]]
+            if name in ['min', 'max']:
+                return f'{name}({", ".join(args)})'
+            if name in ['floor', 'ceil']:
+                return f'math.{name}({args[0]})'
+            if name == 'pow':
+                return f'({args[0]} ** {args[1]})'
+            if name == 'mod':
+                return f'({args[0]} % {args[1]})'
+            raise ValueError(f'Unsupported function {name} in PRISM model')
+        raise ValueError(f'Unsupported expression {expr!r} in PRISM model')
+
+    def function(self, expr):
+        return eval('lambda s: ' + self.compile(expr), {'math': math})
+
+    def evaluate(self, expr):
+        return self.function(expr)(())
+
+    def build(self):
+        '''
+        Explores the reachable state space and returns the explicit DTMC
+        '''
+        for name, expr in self.constants:
+            self.values[name] = self.evaluate(expr)
+        self.var_index = {var[0]: i for i, var in enumerate(self.variables)}
+
+        bounds = []
+        initial = []
+        for name, var_range, init in self.variables:
+            if var_range is None:
+                bounds.append((False, True))
+                initial.append(self.evaluate(init) if init is not None else False)
+            else:
+                low, high = self.evaluate(var_range[0]), self.evaluate(var_range[1])
+                bounds.append((low, high))
+                initial.append(self.evaluate(init) if init is not None else low)
+
+        # compile commands, grouped by module and action
+        modules = []
+        actions = []
+        for name, commands in self.modules:
+            compiled = {}
+            for action, guard, updates in commands:
+                compiled_updates = [(self.function(prob), [(self.var_index[var], self.function(expr)) for var, expr in assignments])
+                                    for prob, assignments in updates]
+                compiled.setdefault(action, []).append((self.function(guard), compiled_updates))
+                if action is not None and action not in actions:
+                    actions.append(action)
+            modules.append(compiled)
+
+        def distributions(commands, s):
+            return [[(prob(s), assignments) for prob, assignments in updates] for guard, updates in commands if guard(s)]
+
+        initial = tuple(initial)
+        index = {initial: 0}
+        states = [initial]
+        rows, cols, probs = [], [], []
+        i = 0
+        while i < len(states):
+            s = states[i]
+            choices = []
+            for module in modules:
+                choices += distributions(module.get(None, []), s)
+            for action in actions:
+                enabled = [distributions(module[action], s) for module in modules if action in module]
+                if all(enabled):
+                    for combination in itertools.product(*enabled):
+                        choice = [(1, [])]
+                        for distribution in combination:
+                            choice = [(p1 * p2, a1 + a2) for p1, a1 in choice for p2, a2 in distribution]
+                        choices.append(choice)
+            if not choices:
+                # deadlocks are fixed with self-loops, as PRISM does
+                choices = [[(1, [])]]
+
+            # nondeterministic choices of a DTMC are resolved uniformly, as PRISM does
+            for choice in choices:
+                for prob, assignments in choice:
+                    succ = list(s)
+                    for var, expr in assignments:
+                        succ[var] = expr(s)
+                    for var, value in enumerate(succ):
+                        if not bounds[var][0] <= value <= bounds[var][1]:
+                            raise ValueError(f'Variable {self.variables[var][0]} out of range in state {s}')
+                    succ = tuple(succ)
+                    if succ not in index:
+                        index[succ] = len(states)
+                        states.append(succ)
+                    rows.append(i)
+                    cols.append(index[succ])
+                    probs.append(prob / len(choices))
+            i += 1
+
+        # PRISM orders the states lexicographically by variable values
+        order = sorted(range(len(states)), key=lambda k: states[k])
+        position = np.empty(len(states), dtype=np.int64)
+        position[order] = np.arange(len(states))
+        states = [states[k] for k in order]
+        transitions = sparse.csr_matrix((probs, (position[rows], position[cols])), shape=(len(states), len(states)))
+
+        dtmc = DTMC(self, states, transitions, int(position[0]))
+        dtmc.add_labels(self.labels)
+        return dtmc
+
+
+class DTMC:
+    '''
+    Explicit DTMC: lexicographically ordered states, sparse transition matrix and labels as boolean vectors
+    '''
+    def __init__(self, model, states, transitions, initial):
+        self.model = model
+        self.states = states
+        self.transitions = transitions
+        self.initial = initial
+        self.num_states = len(states)
+        self.labels = {}
+        init = np.zeros(self.num_states, dtype=bool)
+        init[initial] = True
+        self.labels['init'] = init
+
+    def add_labels(self, labels):
+        '''
+        Evaluates label definitions, given as (name, expression) pairs or as PRISM text, on all states
+        '''
+        if isinstance(labels, str):
+            labels = PrismParser(tokenize(labels)).labels()
+        for name, expr in labels:
+            label_function = self.model.function(expr)
+            self.labels[name] = np.array([bool(label_function(s)) for s in self.states], dtype=bool)
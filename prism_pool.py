@@ -0,0 +1,204 @@
+import os
+import queue
+import signal
+import socket
+import subprocess
+import threading
+import atexit
+import time
+
+
+NAILGUN_CLIENT = 'ngprism'
+JAVA_SECURITY_FLAG = '-Djava.security.manager=allow'
+
+
+def free_port():
+    '''
+    Asks the OS for a currently unused TCP port on the loopback interface
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class PrismWorker:
+    '''
+    A long-lived PRISM worker. With nailgun, the worker owns its own Nailgun server (a warm JVM with PRISM
+    loaded) on a private port, so that a model check does not pay the JVM startup. Without nailgun, the
+    worker simply launches the PRISM binary.
+    '''
+    def __init__(self, worker_id, prism_binary='prism', nailgun=False, client_binary=NAILGUN_CLIENT, startup_timeout=60):
+
+        self.worker_id = worker_id
+        self.prism_binary = prism_binary
+        self.nailgun = nailgun
+        self.client_binary = client_binary
+        self.startup_timeout = startup_timeout
+
+        self.process = None
+        self.port = None
+        self.env = os.environ.copy()
+        # resource usage of the last streamed PRISM call (None with nailgun, the check runs in the server)
+        self.rusage = None
+
+    def is_alive(self):
+        '''
+        Health check: the server process is running and accepts connections on its port
+        '''
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            with socket.create_connection(('127.0.0.1', self.port), timeout=1):
+                return True
+        except OSError:
+            return False
+
+    def start(self):
+        '''
+        Starts the Nailgun server of this worker and waits until it answers
+        '''
+        if not self.nailgun:
+            return True
+        if self._launch(self.env):
+            return True
+        # Java >= 19 refuses to start the Nailgun server unless the security manager is explicitly allowed
+        if 'PRISM_JAVA_PARAMS' not in self.env:
+            env = dict(self.env, PRISM_JAVA_PARAMS=JAVA_SECURITY_FLAG)
+            if self._launch(env):
+                self.env = env
+                return True
+        print(f'Could not start the Nailgun server for PRISM worker {self.worker_id}, falling back to {self.prism_binary}')
+        self.nailgun = False
+        return False
+
+    def _launch(self, env):
+
+        self.port = free_port()
+        self.process = subprocess.Popen([self.prism_binary, '-ng', str(self.port)], stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, env=env, start_new_session=True)
+        deadline = time.time() + self.startup_timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            if self.is_alive():
+                return True
+            time.sleep(0.2)
+        self.stop()
+        return False
+
+    def ensure_started(self):
+        '''
+        Starts the server on first use and restarts it if it died since the last call
+        '''
+        if self.nailgun and not self.is_alive():
+            if self.process is not None:
+                print(f'PRISM worker {self.worker_id} is not responding, restarting it')
+                self.stop()
+            self.start()
+
+    def command(self, args):
+        if self.nailgun:
+            return [self.client_binary] + args
+        return [self.prism_binary] + args
+
+    def run(self, args):
+        '''
+        Runs PRISM with the given command line arguments on this worker
+        '''
+        env = dict(self.env, NAILGUN_PORT=str(self.port)) if self.nailgun else self.env
+        return subprocess.run(self.command(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+
+    def stream(self, args, consume):
+        '''
+        Runs PRISM with the given command line arguments on this worker and passes its standard output,
+        as an iterator of lines, to consume while PRISM is running. Returns the result of consume.
+        '''
+        env = dict(self.env, NAILGUN_PORT=str(self.port)) if self.nailgun else self.env
+        self.rusage = None
+        with subprocess.Popen(self.command(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env,
+                              text=True, bufsize=1 << 16) as process:
+            try:
+                result = consume(process.stdout)
+            except BaseException:
+                process.kill()
+                raise
+            # PRISM is reaped here to get its resource usage (e.g. its peak memory)
+            process.stdout.close()
+            _, status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if not self.nailgun:
+                self.rusage = rusage
+            # the output of a PRISM run that failed may be partial
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
+            return result
+
+    def stop(self):
+
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGTERM)
+                self.process.wait(timeout=10)
+            except (ProcessLookupError, subprocess.TimeoutExpired):
+                self.process.kill()
+        self.process = None
+
+
+class PrismPool:
+    '''
+    Pool of long-lived PRISM workers (by default one per core). Workers are started lazily, health-checked
+    before every call and shut down with the pool.
+    '''
+    def __init__(self, prism_binary='prism', nailgun=False, num_workers=None):
+
+        self.prism_binary = prism_binary
+        self.nailgun = nailgun
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.workers = [PrismWorker(i, prism_binary=prism_binary, nailgun=nailgun) for i in range(self.num_workers)]
+
+        # LIFO so that an already warm worker is reused before a cold one is started
+        self.idle = queue.LifoQueue()
+        for worker in reversed(self.workers):
+            self.idle.put(worker)
+        # resource usage of the last streamed call of every thread
+        self.local = threading.local()
+        atexit.register(self.close)
+
+    def run(self, args):
+        '''
+        Runs one PRISM call on the next idle worker, blocking until one is available
+        '''
+        worker = self.idle.get()
+        try:
+            worker.ensure_started()
+            return worker.run(args)
+        finally:
+            self.idle.put(worker)
+
+    def stream(self, args, consume):
+        '''
+        Runs one PRISM call on the next idle worker, its output is passed to consume as it is produced
+        '''
+        worker = self.idle.get()
+        self.local.rusage = None
+        try:
+            worker.ensure_started()
+            result = worker.stream(args, consume)
+            self.local.rusage = worker.rusage
+            return result
+        finally:
+            self.idle.put(worker)
+
+    def last_rusage(self):
+        '''
+        Resource usage of the last PRISM call streamed by the current thread, None if unknown
+        '''
+        return getattr(self.local, 'rusage', None)
+
+    def close(self):
+        # the pool is not kept alive until the interpreter exits once it is closed
+        atexit.unregister(self.close)
+        for worker in self.workers:
+            worker.stop()
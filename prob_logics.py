@@ -1,3 +1,5 @@
+import itertools
+import weakref
 from lark import Lark, Transformer
 import spot
 
@@ -14,6 +16,8 @@ class SimpleTree:
     '''
     Class for encoding syntax Trees of formulas
     '''
+    __slots__ = ('left', 'right', 'label', 'params', 'tree_size')
+
     def __init__(self, label = "dummy"):	
         self.left = None
         self.right = None
@@ -22,8 +26,7 @@ class SimpleTree:
         self.tree_size = None
 
     def __hash__(self):
-        # return hash((self.label, self.left, self.right))
-        return hash(self.label) + id(self.left) + id(self.right)
+        return hash((self.label, self.left, self.right))
     
     def __eq__(self, other):
         if other is None:
@@ -105,92 +108,139 @@ class SimpleTree:
 
         return self.tree_size
 
+# interned formulas by (label, uid of the left child, uid of the right child), a formula lives as long
+# as it is referenced (by the enumeration or as a subformula)
+interned_formulas = weakref.WeakValueDictionary()
+formula_ids = itertools.count()
+
 class LTLFormula(SimpleTree):
     '''
-    A class for encoding syntax Trees and syntax DAGs of LTL formulas
+    A class for encoding syntax Trees and syntax DAGs of LTL formulas. Formulas are hash-consed: building a
+    formula with the same label and children returns the existing object, so that structurally equal
+    formulas are identical and share their subformulas. The string, size and spot formula are computed
+    on first use.
     '''
-    def __init__(self, formulaArg = "dummyF"):
+    __slots__ = ('uid', '_hash', '_str', '_tree_size', '_spot_formula', '__weakref__')
 
-        self.str = None
-        self.spot_formula = None
-        self.tree_size = None
-        if not isinstance(formulaArg, str):
-            self.label = formulaArg[0]
-            self.left = formulaArg[1]
+    def __new__(cls, formulaArg = "dummyF"):
+
+        if isinstance(formulaArg, str):
+            label, left, right = formulaArg, None, None
+        else:
+            label = formulaArg[0]
+            left = formulaArg[1]
             try:
-                self.right = formulaArg[2]
+                right = formulaArg[2]
             except:
-                self.right = None
-            self.str = self.prettyPrint()
-            self.tree_size = self.treeSize()
-            self.spot_formula = self.genSpotFormula()
-        else:
-            super().__init__(formulaArg)
-            self.str = self.prettyPrint()
-            self.tree_size = self.treeSize()
-            self.spot_formula = self.genSpotFormula()
-    
-    def __lt__(self, other):
+                right = None
+        key = (label, None if left is None else left.uid, None if right is None else right.uid)
+        formula = interned_formulas.get(key)
+        if formula is None:
+            formula = super().__new__(cls)
+            formula.label = label
+            formula.left = left
+            formula.right = right
+            formula.params = None
+            formula._str = None
+            formula._tree_size = None
+            formula._spot_formula = None
+            formula.uid = next(formula_ids)
+            formula._hash = hash((label, None if left is None else left._hash, None if right is None else right._hash))
+            formula = interned_formulas.setdefault(key, formula)
+        return formula
 
-        if self.getDepth() < other.getDepth():
-            return True
-        elif self.getDepth() > other.getDepth():
-            return False
-        else:
-            if self._isLeaf() and other._isLeaf():
-                return self.label < other.label
+    def __init__(self, formulaArg = "dummyF"):
+        # everything is set up in __new__, an interned formula must not be reset
+        pass
 
-            if self.left != other.left:
-                return self.left < other.left
+    def __reduce__(self):
+        # unpickled formulas are interned again in the receiving process
+        return (LTLFormula, ([self.label, self.left, self.right],))
 
-            if self.right is None:
-                return False
-            if other.right is None:
-                return True
-            if self.right != other.right:
-                return self.right < other.right
+    def __hash__(self):
+        return self._hash
 
-            else:
-                return self.label < other.label
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    @property
+    def tree_size(self):
+        if self._tree_size is None:
+            self._tree_size = 1
+            if not self.left is None:
+                self._tree_size += self.left.tree_size
+            if not self.right is None:
+                self._tree_size += self.right.tree_size
+        return self._tree_size
+
+    def treeSize(self):
+        return self.tree_size
+
+    @property
+    def spot_formula(self):
+        return self.genSpotFormula()
+
+    def __lt__(self, other):
+        # total order on formulas: by size, then by their (fully parenthesised, hence unique) string
+        return (self.tree_size, self.prettyPrint()) < (other.tree_size, other.prettyPrint())
 
     def prettyPrint(self, top=False):
-        if self.str is not None:
-            return self.str
+        if self._str is None:
+            self._str = self._prettyPrint(top)
+        return self._str
+
+    def _prettyPrint(self, top=False):
+        if top is True:
+            lb = ""
+            rb = ""
         else:
-            if top is True:
-                lb = ""
-                rb = ""
-            else:
-                lb = "("
-                rb = ")"
-            if self._isLeaf():
-                return self.label
-            if self.label in unary_operators:
-                return self.label + lb + self.left.prettyPrint() + rb
-            if self.label in binary_operators:
-                return lb + self.left.prettyPrint() + rb + self.label + lb + self.right.prettyPrint() + rb
+            lb = "("
+            rb = ")"
+        if self._isLeaf():
+            return self.label
+        if self.label in unary_operators:
+            return self.label + lb + self.left.prettyPrint() + rb
+        if self.label in binary_operators:
+            return lb + self.left.prettyPrint() + rb + self.label + lb + self.right.prettyPrint() + rb
+
+    def prismPrint(self):
+        '''
+        Prints the formula the way PRISM echoes the properties written with prettyPrint
+        '''
+        if self._isLeaf():
+            return self.label
+        if self.label in temporal_unary:
+            return self.label + ' (' + self.left.prismPrint() + ')'
+        if self.label in bool_unary:
+            return self.label + '(' + self.left.prismPrint() + ')'
+        if self.label in temporal_binary:
+            return '(' + self.left.prismPrint() + ') ' + self.label + ' (' + self.right.prismPrint() + ')'
+        return '(' + self.left.prismPrint() + ')' + self.label + '(' + self.right.prismPrint() + ')'
 
     def genSpotFormula(self):
-        if self.spot_formula is None:
+        if self._spot_formula is None:
             if self._isLeaf():
-                self.spot_formula = spot.formula(self.label)
+                self._spot_formula = spot.formula(self.label)
             else:
                 if self.label == 'X':
-                    self.spot_formula = spot.formula.X(self.left.genSpotFormula())
+                    self._spot_formula = spot.formula.X(self.left.genSpotFormula())
                 if self.label == 'F':
-                    self.spot_formula = spot.formula.F(self.left.genSpotFormula())
+                    self._spot_formula = spot.formula.F(self.left.genSpotFormula())
                 if self.label == 'G':
-                    self.spot_formula = spot.formula.G(self.left.genSpotFormula())
+                    self._spot_formula = spot.formula.G(self.left.genSpotFormula())
                 if self.label == 'U':
-                    self.spot_formula = spot.formula.U(self.left.genSpotFormula(), self.right.genSpotFormula())
+                    self._spot_formula = spot.formula.U(self.left.genSpotFormula(), self.right.genSpotFormula())
                 if self.label == '!':
-                    self.spot_formula = spot.formula.Not(self.left.genSpotFormula())
+                    self._spot_formula = spot.formula.Not(self.left.genSpotFormula())
                 if self.label == '&':
-                    self.spot_formula = spot.formula.And([self.left.genSpotFormula(), self.right.genSpotFormula()])
+                    self._spot_formula = spot.formula.And([self.left.genSpotFormula(), self.right.genSpotFormula()])
                 if self.label == '|':
-                    self.spot_formula = spot.formula.Or([self.left.genSpotFormula(), self.right.genSpotFormula()])
+                    self._spot_formula = spot.formula.Or([self.left.genSpotFormula(), self.right.genSpotFormula()])
                 
-        return self.spot_formula
+        return self._spot_formula
 
 
     @classmethod
@@ -228,6 +278,42 @@ class LTLFormula(SimpleTree):
         f = TreeToLTLFormula().transform(tree)
         return f
 
+    @classmethod
+    def convertPrettyToFormula(cls, formulaText):
+        '''
+        Parses formulas in infix notation, as printed by prettyPrint or prismPrint
+        '''
+        global pretty_parser
+        if pretty_parser is None:
+            pretty_parser = Lark(r"""
+                ?formula: or_formula
+                ?or_formula: and_formula
+                        | or_formula OR and_formula -> binary
+                ?and_formula: until_formula
+                        | and_formula AND until_formula -> binary
+                ?until_formula: unary_formula
+                        | unary_formula UNTIL unary_formula -> binary
+                ?unary_formula: atom
+                        | UNARY_OPERATOR unary_formula -> unary
+                ?atom: "(" formula ")"
+                        | LABEL -> variable
+                        | NEGATED_LABEL -> variable
+                        | CONSTANT -> variable
+                OR: "|"
+                AND: "&"
+                UNTIL: "U"
+                UNARY_OPERATOR: "!" | "X" | "F" | "G"
+                LABEL: /"[^"]*"/
+                NEGATED_LABEL: /!"[^"]*"/
+                CONSTANT: "true" | "false"
+
+                %import common.WS
+                %ignore WS
+             """, start = 'formula', parser = 'lalr')
+
+        tree = pretty_parser.parse(formulaText)
+        return PrettyToLTLFormula().transform(tree)
+
 class TreeToLTLFormula(Transformer):
         def formula(self, formulaArgs):
             if not isinstance(formulaArgs[0], str): formulaArgs.insert(0, formulaArgs.pop(1))
@@ -241,5 +327,15 @@ class TreeToLTLFormula(Transformer):
         def unary_operator(self, args):
             return str(args[0])
 
+class PrettyToLTLFormula(Transformer):
+        def binary(self, args):
+            return LTLFormula([str(args[1]), args[0], args[2]])
+        def unary(self, args):
+            return LTLFormula([str(args[0]), args[1], None])
+        def variable(self, args):
+            return LTLFormula([str(args[0]), None, None])
+
+pretty_parser = None
+
 
 
@@ -0,0 +1,108 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+class ResultCache:
+    '''
+    Persistent, content-addressed cache of model checking results: maps (model, labels, property) to the
+    formula key and per-state vector returned by the backend. Backed by SQLite, so that the processes of
+    a multiprocessing pool can share it, and bounded in size by evicting the least recently used entries.
+    '''
+    def __init__(self, cache_file, max_size_mb=1024, namespace=''):
+
+        self.cache_file = cache_file
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.namespace = namespace
+        self.model_hashes = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, timeout=120, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, formula TEXT, vector BLOB, size INTEGER, last_used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)')
+
+    def model_hash(self, pm_file):
+
+        if pm_file not in self.model_hashes:
+            with open(pm_file, 'rb') as f:
+                self.model_hashes[pm_file] = hashlib.sha256(f.read()).hexdigest()
+        return self.model_hashes[pm_file]
+
+    def key(self, pm_file, labels, prop, variant=''):
+        '''
+        Key of a property on a model: hash of the model contents, the label definitions and the property
+        without whitespace (so that the formatting of the property files does not matter). The variant
+        separates results computed with different settings within the namespace.
+        '''
+        content = '\n'.join([self.namespace + variant, self.model_hash(pm_file), labels, ''.join(prop.split())])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get_many(self, keys):
+        '''
+        Returns {key: (formula, vector)} for the keys found in the cache
+        '''
+        found = {}
+        now = time.time()
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                marks = ','.join('?' * len(chunk))
+                rows = self.conn.execute(f'SELECT key, formula, vector FROM results WHERE key IN ({marks})', chunk).fetchall()
+                for key, formula, vector in rows:
+                    found[key] = (formula, np.frombuffer(vector, dtype=np.float64))
+                if rows:
+                    with self.conn:
+                        self.conn.execute(f'UPDATE results SET last_used = ? WHERE key IN ({marks})', [now] + chunk)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries):
+        '''
+        Stores (key, formula, vector) entries and evicts the least recently used entries above the size bound
+        '''
+        now = time.time()
+        rows = []
+        for key, formula, vector in entries:
+            blob = np.asarray(vector, dtype=np.float64).tobytes()
+            rows.append((key, formula, blob, len(blob), now))
+        with self.lock:
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', rows)
+            self.evict()
+
+    def evict(self):
+
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_size:
+            return
+        # evict down to 90% of the bound so that eviction does not run on every insertion
+        excess = total - int(0.9 * self.max_size)
+        with self.conn:
+            cursor = self.conn.execute('SELECT key, size FROM results ORDER BY last_used')
+            victims = []
+            for key, size in cursor:
+                victims.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            self.conn.executemany('DELETE FROM results WHERE key = ?', victims)
+        self.evictions += len(victims)
+
+    def stats(self):
+
+        lookups = self.hits + self.misses
+        return {'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'cache_evictions': self.evictions}
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,163 @@
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from separator import Separator
+from model_store import ModelStore
+
+
+class SchedulerClient:
+    '''
+    Handle of the scheduler used by the learning runs (picklable, so it can be passed to pool processes):
+    submits the model checks and waits for their results
+    '''
+    def __init__(self, tasks, results, claims, stats, lock, poll_interval=0.05):
+
+        self.tasks = tasks
+        # key -> (completion time, output dict or None)
+        self.results = results
+        self.claims = claims
+        self.stats = stats
+        self.lock = lock
+        self.poll_interval = poll_interval
+        self.model_hashes = {}
+
+    def key(self, pm_file, tl_text):
+
+        if pm_file not in self.model_hashes:
+            with open(pm_file, 'rb') as f:
+                self.model_hashes[pm_file] = hashlib.sha256(f.read()).hexdigest()
+        return hashlib.sha256((self.model_hashes[pm_file] + '\n' + tl_text).encode()).hexdigest()
+
+    def check(self, pm_file, tl_file, compact=False, explicit=False, precision=None):
+        '''
+        Checks a property file on a model through the scheduler. A task already submitted by any run
+        (same model contents, properties, checking mode and precision) is not checked again, its result is shared.
+        Returns None if the check failed.
+        '''
+        with open(tl_file, 'r') as f:
+            tl_text = f.read()
+        key = self.key(pm_file, tl_text + ('compact' if compact else '') + ('explicit' if explicit else '') + (f'epsilon={precision}' if precision is not None else ''))
+        token = f'{os.getpid()}-{threading.get_ident()}'
+
+        owner = None
+        while True:
+            entry = self.results.get(key)
+            if entry is not None:
+                if owner != token:
+                    self.count('deduplicated')
+                return entry[1]
+            # the first run to claim a task submits it, the others wait for its result (results expire
+            # after a while, a task is then claimed and submitted again)
+            current = self.claims.setdefault(key, token)
+            if current == token and owner != token:
+                self.tasks.put((key, os.path.abspath(pm_file), tl_text, compact, explicit, precision))
+                self.count('submitted')
+            owner = current
+            time.sleep(self.poll_interval)
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+
+def run_checker(tasks, results, done_times, stats, lock, task_folder, prism_binary, nailgun, backend, incremental):
+    '''
+    Checker process: takes the next task of the shared queue until it gets None
+    '''
+    checker = Separator(positive=[], negative=[], verbose=False, delta=0, bsc=None, prism_binary=prism_binary,
+                        nailgun=nailgun, num_workers=1, backend=backend, incremental=incremental)
+    model_store = ModelStore()
+    tl_file = os.path.join(task_folder, f'task-{os.getpid()}.pltl')
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        key, pm_file, tl_text, compact, explicit, precision = task
+        checker.compact = compact
+        checker.model_store = model_store if explicit else None
+        if backend == 'native':
+            checker.native_checker.model_store = checker.model_store
+        with open(tl_file, 'w') as f:
+            f.write(tl_text)
+        try:
+            output_dict = checker.model_check(pm_file, tl_file, precision)
+        except Exception as e:
+            print(f'Scheduler: could not check {pm_file}: {e}')
+            output_dict = None
+        done_time = time.time()
+        results[key] = (done_time, output_dict)
+        done_times[key] = done_time
+        with lock:
+            stats['done'] += 1
+    checker.close()
+
+
+class CheckScheduler:
+    '''
+    Global scheduler of the model checks of all the learning runs of an experiment. The runs submit
+    (model, property batch) tasks to a shared queue that a fixed set of checker processes take their
+    next task from, so a slow run does not hold back idle cores. Identical tasks (same model contents
+    and properties) of different runs are checked once. Progress and throughput are reported periodically.
+    '''
+    def __init__(self, num_checkers, prism_binary='prism', nailgun=False, backend='prism', incremental=False, report_interval=30, retention=600):
+
+        self.report_interval = report_interval
+        self.retention = retention
+        self.manager = multiprocessing.Manager()
+        self.tasks = self.manager.Queue()
+        self.results = self.manager.dict()
+        self.claims = self.manager.dict()
+        self.done_times = self.manager.dict()
+        self.stats = self.manager.dict(submitted=0, deduplicated=0, done=0)
+        self.lock = self.manager.Lock()
+        self.task_folder = tempfile.mkdtemp(prefix='pritl-tasks-')
+
+        checker_args = (self.tasks, self.results, self.done_times, self.stats, self.lock, self.task_folder, prism_binary, nailgun, backend, incremental)
+        self.checkers = [multiprocessing.Process(target=run_checker, args=checker_args, daemon=True) for _ in range(num_checkers)]
+        for checker in self.checkers:
+            checker.start()
+
+        self.start_time = time.time()
+        self.stopped = threading.Event()
+        self.reporter = threading.Thread(target=self.report, daemon=True)
+        self.reporter.start()
+
+    def client(self):
+        return SchedulerClient(self.tasks, self.results, self.claims, self.stats, self.lock)
+
+    def report(self):
+        '''
+        Prints the progress and throughput, and drops the results kept longer than the retention time
+        '''
+        last_done, last_time = 0, self.start_time
+        while not self.stopped.wait(self.report_interval):
+            now = time.time()
+            stats = dict(self.stats)
+            rate = (stats['done'] - last_done) / (now - last_time)
+            print(f"Scheduler: {stats['done']} checks done, {stats['submitted'] - stats['done']} pending, "
+                  f"{stats['deduplicated']} deduplicated, {rate:.2f} checks/s "
+                  f"({stats['done'] / (now - self.start_time):.2f} overall)")
+            last_done, last_time = stats['done'], now
+
+            for key, done_time in list(self.done_times.items()):
+                if done_time < now - self.retention:
+                    self.claims.pop(key, None)
+                    self.results.pop(key, None)
+                    self.done_times.pop(key, None)
+
+    def close(self):
+
+        self.stopped.set()
+        for _ in self.checkers:
+            self.tasks.put(None)
+        for checker in self.checkers:
+            checker.join()
+        stats = dict(self.stats)
+        elapsed = time.time() - self.start_time
+        print(f"Scheduler: {stats['done']} checks done, {stats['deduplicated']} deduplicated, {stats['done'] / elapsed:.2f} checks/s")
+        self.manager.shutdown()
+        shutil.rmtree(self.task_folder, ignore_errors=True)
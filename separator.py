@@ -1,22 +1,61 @@
 import os
+import itertools
+import shutil
 import subprocess
-from gen_logics import GrammarGenPLTL
-from boolcomb import Boolcomb
+import threading
+from gen_logics import GrammarGenPLTL, GrammarPipeline, spot_memo_file
+from boolcomb import Boolcomb, THRESHOLD_CUTOFF, best_thresholds
 import numpy as np
 import time
 import json
 import heapq as hq
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from prism_pool import PrismPool
+from native_checker import NativeChecker, read_property_file
+from result_cache import ResultCache
+from model_store import ModelStore
+from bisimulation import quotient_models
+from smc import SMCPrefilter
+from checkpoint import Checkpoint
 
 
 PRQUERY = "=?"
+PRISM_SEPARATOR = '---------------------------------------------------------------------'
+# number of vector entries converted at once by the streaming parser
+VECTOR_CHUNK = 65536
+# semaphore bounding the number of model checks running at once over all the learning runs (processes)
+check_budget = None
+
+def set_check_budget(semaphore):
+    '''
+    Sets the global model checking budget, to be called in every process (e.g. as Pool initializer)
+    '''
+    global check_budget
+    check_budget = semaphore
 
 class Separator:
     '''
     Class that implements the probabilistic threshold search (PTS) procedure: (i) performs model checking and (ii) consistency checking
     '''
-    def __init__(self, positive, negative, verbose, delta, bsc, prism_binary='prism', formula_type='.pltl', only_minimal=True, only_greater=True, only_smaller=False):
+    def __init__(self, positive, negative, verbose, delta, bsc, prism_binary='prism', formula_type='.pltl', only_minimal=True, only_greater=True, only_smaller=False, nailgun=False, num_workers=None, backend='prism', cache=None, scheduler=None, compact=False, model_store=None, early_abort=False, bsc_policy='lazy', precision=None, incremental=False, chunk_size=None, chunk_retries=2):
         
         self.prism_binary = prism_binary
+        self.pool = PrismPool(prism_binary=prism_binary, nailgun=nailgun, num_workers=num_workers)
+        # the models of a batch are checked concurrently, one thread per PRISM worker
+        self.executor = ThreadPoolExecutor(max_workers=self.pool.num_workers)
+        self.backend = backend
+        # explicit models compiled once, reused by all the checks
+        self.model_store = model_store
+        if backend == 'native':
+            self.native_checker = NativeChecker(model_store=model_store, incremental=incremental)
+        elif backend != 'prism':
+            raise ValueError(f'Unknown model checking backend {backend}')
+        elif incremental:
+            raise ValueError('Incremental evaluation needs the native backend')
+        self.cache = cache
+        # client of the global scheduler of main.py, checks are then run by its checker processes
+        self.scheduler = scheduler
         self.positive = positive
         self.negative = negative
         self.verbose = verbose
@@ -24,6 +63,35 @@ class Separator:
         self.answer_file = 'answer' + formula_type
         self.all_results = {}
         self.prism_flags = ['--maxiters', '1000000', '--exportvector', 'stdout']
+        # compact results: [value in the first state, minimum, maximum] instead of the vector over all states,
+        # enough for the thresholds and the discard heuristic
+        self.compact = compact
+        if self.cache is not None:
+            # results of different backends, PRISM settings or result modes are cached separately
+            self.cache.namespace = ' '.join([backend] + self.prism_flags + (['compact'] if compact else []))
+
+        # early abort: the formulas that cannot separate the examples anymore are not checked on the remaining models,
+        # the boolean combinations either skip them or get their results once no formula of the batch separates
+        if bsc_policy not in ['skip', 'lazy']:
+            raise ValueError(f'Unknown boolean combination policy {bsc_policy}')
+        self.early_abort = early_abort
+        self.bsc_policy = bsc_policy
+        self.abort_skipped = 0
+        self.abort_completed = 0
+        # formulas dropped by the statistical pre-filter and checked for the boolean combinations
+        self.deferred_checked = 0
+        # two-tier checking: the batches are first checked with interval iteration up to an absolute error of precision,
+        # and only the formulas whose verdict or boolean combination classification could change are checked exactly
+        self.precision = precision
+        self.coarse_time = 0
+        self.refine_time = 0
+        self.refined = 0
+        # property files of more than chunk_size properties are checked by chunks, a failed chunk is checked again
+        # (up to chunk_retries times) without the completed ones
+        self.chunk_size = chunk_size
+        self.chunk_retries = chunk_retries
+        self.chunk_stats = []
+        self.chunk_lock = threading.Lock()
 
         self.max_diff = 0
         self.max_diff_formula = None
@@ -37,113 +105,333 @@ class Separator:
         self.separation_time = 0
         self.PRISM_time = 0
 
-    def generate_probs(self, tl_file, formula_size):
+    def generate_probs(self, tl_file, formula_size, deferred_file=None):
         '''
-        Function that generates the probability thresholds for each model
+        Function that generates the probability thresholds for each model. The formulas of the deferred file
+        are only checked if no formula of tl_file separates the examples, their rows follow those of tl_file.
         '''
         self.formula_size = formula_size
-        self.results = {}
-        self.discards = {}
         prism_runtime = 0
 
-        for pos in self.positive:
-            t0 = time.time()
-            output_dict = self.run_prism(pos, tl_file)
-            prism_runtime += time.time() - t0
-            for formula in output_dict:
-                if formula not in self.results:
-                    self.results[formula] = [np.array([]), np.array([])]
-                    self.discards[formula] = [np.array([]), np.array([])]
-                self.results[formula][0] = np.append(self.results[formula][0], output_dict[formula][0])
-
-                # discarding heursitics
-                if np.all(output_dict[formula] == 1):
-                    self.discards[formula][0] = np.append(self.discards[formula][0], 1)
-                elif np.all(output_dict[formula] == 0):
-                    self.discards[formula][0] = np.append(self.discards[formula][0], 0)
-                else:
-                    self.discards[formula][0] = np.append(self.discards[formula][0], -1)
+        # one row per formula, the positive models first and then the negative models as columns
+        labels, properties = read_property_file(tl_file)
+        models = self.positive + self.negative
+        self.num_pos = len(self.positive)
+        self.formulas = []
+        self.formula_index = {}
 
-        for neg in self.negative:
+        t0 = time.time()
+        precision = self.precision
+        # results not checked (early abort) or missing from the output of a model are unknown, not a zero probability
+        self.results = np.full((len(properties), len(models)), np.nan)
+        self.discards = np.full((len(properties), len(models)), -1, dtype=np.int8)
+        if self.early_abort:
+            self.check_adaptively(tl_file, labels, properties, models, precision)
+        else:
+            outputs = self.check_models(models, [tl_file] * len(models), precision)
+            # the longest output comes first, so that the rows follow the properties even if some outputs miss formulas
+            for column in sorted(range(len(models)), key=lambda column: -len(outputs[column] or {})):
+                self.store_results(column, outputs[column])
+
+        # PRISM reports a formula written twice in the property file only once
+        self.results = self.results[:len(self.formulas)]
+        self.discards = self.discards[:len(self.formulas)]
+        if not self.early_abort:
+            self.check_complete(labels, properties, models, os.path.dirname(tl_file), precision)
+        prism_runtime += time.time() - t0
+        self.coarse_time += time.time() - t0 if precision is not None else 0
+
+        self.exact = np.full(len(self.formulas), precision is None)
+        if precision is not None:
+            # exact results for the formulas that separate the examples or could within the error bound
             t0 = time.time()
-            output_dict = self.run_prism(neg, tl_file)
+            self.refine(np.flatnonzero(self.separable(precision)), tl_file, labels, properties, models)
             prism_runtime += time.time() - t0
-            for formula in output_dict:
-                self.results[formula][1] = np.append(self.results[formula][1], output_dict[formula][0])
-                
-                # discarding heursitics
-                if np.all(output_dict[formula] == 1):
-                    self.discards[formula][0] = np.append(self.discards[formula][0], 1)
-                elif np.all(output_dict[formula] == 0):
-                    self.discards[formula][0] = np.append(self.discards[formula][0], 0)
-                else:
-                    self.discards[formula][0] = np.append(self.discards[formula][0], -1)
-
-        formula_list = list(self.results.keys())
-        discard_index = []
-        for i in range(len(formula_list)):
-            formula = formula_list[i]
-
-            # discard condition
-            discard_cond = np.all(self.discards[formula][0] == 1) and np.all(self.discards[formula][0] == 1) or np.all(self.discards[formula][0] == 0) and np.all(self.discards[formula][0] == 0)
-            if discard_cond:
-                self.discard_counter += 1
-                discard_index.append(i)
-            else:
-                #calculate score for the formula
-                if np.all(self.results[formula][0]==0) or np.all(self.results[formula][1]==1):
-                    continue
-                score_formula = self.bsc.score(formula, formula_size[0], self.results[formula])
-                self.bsc.size[formula] = formula_size[0]
-                hq.heappush(self.bsc.heap, (-score_formula, formula))
-        
+
         checking_time = time.time()
         check = self.check_separation()
         checking_time = time.time() - checking_time
 
+        if deferred_file is not None and not check:
+            # no formula separates, so the boolean combinations are searched: they need the deferred formulas
+            t0 = time.time()
+            properties = properties + self.add_deferred(deferred_file, models, precision)
+            if precision is not None:
+                self.refine(np.flatnonzero(self.separable(precision)), tl_file, labels, properties, models)
+            prism_runtime += time.time() - t0
+            t0 = time.time()
+            check = self.check_separation()
+            checking_time += time.time() - t0
+
+        if self.early_abort and not check and self.bsc_policy == 'lazy':
+            # no formula separates, so the boolean combinations are searched: they need the aborted formulas
+            t0 = time.time()
+            self.abort_completed += self.complete_results(labels, properties, models, os.path.dirname(tl_file), precision)
+            prism_runtime += time.time() - t0
+            self.coarse_time += time.time() - t0 if precision is not None else 0
+
+        # discard condition: the formula is trivially true or trivially false on all the models
+        discard_cond = np.all(self.discards == 1, axis=1) | np.all(self.discards == 0, axis=1)
+        discard_index = np.flatnonzero(discard_cond).tolist()
+        self.discard_counter += len(discard_index)
+        pos_results = self.results[:, :self.num_pos]
+        neg_results = self.results[:, self.num_pos:]
+
+        # formulas scored by boolean combination: not discarded, not zero on all positives, not one on all negatives
+        # (and checked on all the models)
+        score_cond = ~discard_cond & ~np.all(pos_results == 0, axis=1) & ~np.all(neg_results == 1, axis=1) & ~np.isnan(self.results).any(axis=1)
+        score_index = np.flatnonzero(score_cond)
+        if precision is not None:
+            # exact results for the formulas whose thresholds could classify the examples differently
+            t0 = time.time()
+            self.refine(score_index[self.classification_uncertain(score_index, precision)], tl_file, labels, properties, models)
+            prism_runtime += time.time() - t0
+        score_formulas = [self.formulas[i] for i in score_index]
+        scores = self.bsc.score_batch(score_formulas, formula_size[0], pos_results[score_index], neg_results[score_index])
+        for formula, score_formula in zip(score_formulas, scores):
+            self.bsc.size[formula] = formula_size[0]
+            hq.heappush(self.bsc.heap, (-score_formula, formula))
+
         self.separation_time += checking_time
         self.PRISM_time += prism_runtime
 
         return check, discard_index
 
+    def add_deferred(self, tl_file, models, precision=None):
+        '''
+        Checks the formulas of a deferred property file on all the models and adds their rows, returns the properties
+        '''
+        _, properties = read_property_file(tl_file)
+        first = len(self.formulas)
+        self.results = np.vstack([self.results, np.full((len(properties), len(models)), np.nan)])
+        self.discards = np.vstack([self.discards, np.full((len(properties), len(models)), -1, dtype=np.int8)])
+        outputs = self.check_models(models, [tl_file] * len(models), precision)
+        for column in sorted(range(len(models)), key=lambda column: -len(outputs[column])):
+            self.store_results(column, outputs[column])
+        self.results = self.results[:len(self.formulas)]
+        self.discards = self.discards[:len(self.formulas)]
+        if np.isnan(self.results[first:]).any():
+            raise RuntimeError(f'Results of {tl_file} missing from the model checking output')
+        self.exact = np.concatenate([self.exact, np.full(len(self.formulas) - first, precision is None)])
+        self.deferred_checked += len(self.formulas) - first
+        return properties
+
+    def check_models(self, pm_files, tl_files, precision=None):
+        '''
+        Checks the property files on the models concurrently. A failed check (PRISM error or crash, no output)
+        is run again once before the batch fails.
+        '''
+        outputs = list(self.executor.map(self.cached_model_check, pm_files, tl_files, [precision] * len(pm_files)))
+        for i, output_dict in enumerate(outputs):
+            if not output_dict:
+                print(f'Model checking of {tl_files[i]} on {pm_files[i]} failed, checking it again')
+                outputs[i] = self.cached_model_check(pm_files[i], tl_files[i], precision)
+                if not outputs[i]:
+                    raise RuntimeError(f'Model checking of {tl_files[i]} on {pm_files[i]} failed')
+        return outputs
+
+    def store_results(self, column, output_dict):
+        '''
+        Stores the results of a model: the value in the first state and the discard status of every formula
+        '''
+        for formula in output_dict:
+            if formula not in self.formula_index:
+                self.formula_index[formula] = len(self.formulas)
+                self.formulas.append(formula)
+            row = self.formula_index[formula]
+            self.results[row, column] = output_dict[formula][0]
+
+            # discarding heursitics
+            if np.all(output_dict[formula] == 1):
+                self.discards[row, column] = 1
+            elif np.all(output_dict[formula] == 0):
+                self.discards[row, column] = 0
+            else:
+                self.discards[row, column] = -1
+
+    def separable(self, error=0):
+        '''
+        Formulas that can separate the examples given the results known so far, each known with the given absolute error
+        '''
+        pos_results = self.results[:, :self.num_pos]
+        neg_results = self.results[:, self.num_pos:]
+        # bounds of the final extremes, infinite while no model of the side is checked
+        min_pos = np.where(np.isnan(pos_results), np.inf, pos_results).min(axis=1)
+        max_pos = np.where(np.isnan(pos_results), -np.inf, pos_results).max(axis=1)
+        min_neg = np.where(np.isnan(neg_results), np.inf, neg_results).min(axis=1)
+        max_neg = np.where(np.isnan(neg_results), -np.inf, neg_results).max(axis=1)
+        greater = self.only_greater & (min_pos - max_neg > self.delta - 2*error) & (min_pos >= 0.8 - error)
+        smaller = self.only_smaller & (min_neg - max_pos > self.delta - 2*error)
+        return greater | smaller
+
+    def may_separate(self, checked, error=0):
+        '''
+        Formulas that can still separate the examples or be discarded given the results on the checked models
+        '''
+        # the discard heuristic needs the formulas trivially true or false on all the models
+        trivial = np.all((self.discards == 1) | ~checked, axis=1) | np.all((self.discards == 0) | ~checked, axis=1)
+        return self.separable(error) | trivial
+
+    def classification_uncertain(self, rows, error):
+        '''
+        Whether the boolean combination classification of the formulas can change within the error bound: a
+        positive and a negative result are close enough to be ordered differently, or the best threshold is close
+        enough to the cutoff of the combinations to fall on the other side of it. Otherwise the threshold of the
+        coarse results is within the error of the exact one and classifies the examples the same way.
+        '''
+        values = self.results[rows]
+        order = np.argsort(values, axis=1, kind='stable')
+        is_positive = order < self.num_pos
+        gaps = np.diff(np.take_along_axis(values, order, axis=1), axis=1)
+        _, thresholds = best_thresholds(values[:, :self.num_pos], values[:, self.num_pos:])
+        return np.any((is_positive[:, 1:] != is_positive[:, :-1]) & (gaps <= 2*error), axis=1) | (np.abs(thresholds - THRESHOLD_CUTOFF) <= error)
+
+    def exact_results(self):
+        '''
+        Results of the batch, the rows known only up to the coarse error are unknown (NaN)
+        '''
+        return np.where(self.exact[:, None], self.results, np.nan)
+
+    def refine(self, rows, tl_file, labels, properties, models):
+        '''
+        Checks the formulas of the given rows exactly on all the models
+        '''
+        rows = rows[~self.exact[rows]]
+        if len(rows) == 0:
+            return
+        t0 = time.time()
+        if len(self.formulas) == len(properties):
+            refine_file = os.path.join(os.path.dirname(tl_file), f'refine-{os.getpid()}-{threading.get_ident()}.pltl')
+            with open(refine_file, 'w') as f:
+                f.write(labels)
+                for row in rows:
+                    f.write(properties[row] + '\n')
+        else:
+            # results cannot be matched with the lines of the property file
+            refine_file = tl_file
+            rows = np.arange(len(self.formulas))
+        outputs = self.check_models(models, [refine_file] * len(models))
+        for column, output_dict in enumerate(outputs):
+            self.store_results(column, output_dict)
+        if refine_file != tl_file:
+            os.remove(refine_file)
+        self.exact[rows] = True
+        self.refined += len(rows)
+        self.refine_time += time.time() - t0
+
+    def check_adaptively(self, tl_file, labels, properties, models, precision=None):
+        '''
+        Early-abort checking: the models are checked in rounds (one model per worker), alternating positive and
+        negative models, and the later rounds only check the formulas that can still separate the examples
+        '''
+        positive = list(range(self.num_pos))
+        negative = list(range(self.num_pos, len(models)))
+        order = [column for pair in itertools.zip_longest(positive, negative) for column in pair if column is not None]
+        round_size = self.pool.num_workers
+        checked = np.zeros(self.results.shape, dtype=bool)
+        rows = np.arange(len(properties))
+        round_file = tl_file
+        for start in range(0, len(order), round_size):
+            columns = order[start:start+round_size]
+            outputs = self.check_models([models[column] for column in columns], [round_file] * len(columns), precision)
+            if round_file != tl_file:
+                os.remove(round_file)
+            for column, output_dict in zip(columns, outputs):
+                self.store_results(column, output_dict)
+                checked[rows, column] = True
+            if start == 0 and len(self.formulas) != len(properties):
+                # results cannot be matched with the lines of the property file, the remaining models check all of them
+                print('Could not match the results with the properties, checking all the formulas on all the models')
+                remaining = len(order) - len(columns)
+                outputs = self.check_models([models[column] for column in order[len(columns):]], [tl_file] * remaining, precision)
+                for column, output_dict in zip(order[len(columns):], outputs):
+                    self.store_results(column, output_dict)
+                return
+
+            rows = np.flatnonzero(self.may_separate(checked, precision or 0))
+            if start + round_size >= len(order) or len(rows) == 0:
+                break
+            round_file = os.path.join(os.path.dirname(tl_file), f'survivors-{os.getpid()}-{threading.get_ident()}.pltl')
+            with open(round_file, 'w') as f:
+                f.write(labels)
+                for row in rows:
+                    f.write(properties[row] + '\n')
+        self.abort_skipped += int((~checked).sum())
+
+    def complete_results(self, labels, properties, models, folder, precision=None):
+        '''
+        Checks the aborted formulas on the models they were not checked on, returns the number of checks
+        '''
+        unchecked = np.isnan(self.results)
+        columns = [column for column in range(len(models)) if unchecked[:, column].any()]
+        files = []
+        for column in columns:
+            files.append(os.path.join(folder, f'aborted-{os.getpid()}-{threading.get_ident()}-{column}.pltl'))
+            with open(files[-1], 'w') as f:
+                f.write(labels)
+                for row in np.flatnonzero(unchecked[:, column]):
+                    f.write(properties[row] + '\n')
+        outputs = self.check_models([models[column] for column in columns], files, precision)
+        for column, output_dict, file in zip(columns, outputs, files):
+            self.store_results(column, output_dict)
+            os.remove(file)
+        return int(unchecked.sum())
+
+    def check_complete(self, labels, properties, models, folder, precision=None):
+        '''
+        Checks again the formulas missing from the output of some models (e.g. a PRISM run that stopped early),
+        fails if results are still missing
+        '''
+        missing = int(np.isnan(self.results).sum())
+        if missing == 0:
+            return
+        if len(self.formulas) == len(properties):
+            print(f'{missing} results missing from the model checking output, checking them again')
+            self.complete_results(labels, properties, models, folder, precision)
+            missing = int(np.isnan(self.results).sum())
+        if missing:
+            raise RuntimeError(f'{missing} results missing from the model checking output of {len(models)} models')
+
     def check_separation(self):
         '''
         Checks if the formulas are separating the positive and negative examples with the computed thresholds
         '''
         answers = []
-        for formula in self.results:
-            
-            
-            result_formula = None
-            pos_results = self.results[formula][0]
-            neg_results = self.results[formula][1]
-            
-            max_pos = max(pos_results)
-            min_neg = min(neg_results)
-            min_pos = min(pos_results)
-            max_neg = max(neg_results)
-            
-            if self.only_smaller:
-                if max_pos < min_neg and min_neg - max_pos > self.delta:
-                    mid_val = round((min_neg+max_pos)/2,5)
-                    if mid_val >= 0.5:
-                        continue
-                    result_formula = formula.replace(PRQUERY, '<'+str(round((min_neg+max_pos)/2,5)))
-                    answers.append(result_formula)
-                    if min_neg - max_pos > self.max_diff:
-                        self.max_diff = min_neg - max_pos
-                        self.max_diff_formula = result_formula
-            if self.only_greater:
-                
-                if min_pos > max_neg and min_pos - max_neg > self.delta:
-                    mid_val = round((min_pos+max_neg)/2,5)
-                    if min_pos < 0.8:
-                        continue
-                    result_formula = formula.replace(PRQUERY, '>'+str(mid_val))
-                    answers.append(result_formula)
-                    if min_pos - max_neg > self.max_diff:
-                        self.max_diff = min_pos - max_neg
-                        self.max_diff_formula = result_formula
+        pos_results = self.results[:, :self.num_pos]
+        neg_results = self.results[:, self.num_pos:]
+
+        # per-formula extremes over the whole batch at once
+        max_pos = pos_results.max(axis=1)
+        min_neg = neg_results.min(axis=1)
+        min_pos = pos_results.min(axis=1)
+        max_neg = neg_results.max(axis=1)
+
+        smaller_diff = min_neg - max_pos
+        smaller_mid = np.round((min_neg+max_pos)/2, 5)
+        smaller = (max_pos < min_neg) & (smaller_diff > self.delta) & self.only_smaller
+        # a smaller-than separation with a threshold >= 0.5 rules the formula out altogether
+        excluded = smaller & (smaller_mid >= 0.5)
+        smaller &= ~excluded
+
+        greater_diff = min_pos - max_neg
+        greater_mid = np.round((min_pos+max_neg)/2, 5)
+        greater = (min_pos > max_neg) & (greater_diff > self.delta) & (min_pos >= 0.8) & ~excluded & self.only_greater
+
+        # result strings are only built for the separating formulas, in the order of the batch
+        for i in np.flatnonzero(smaller | greater):
+            formula = self.formulas[i]
+            if smaller[i]:
+                result_formula = formula.replace(PRQUERY, '<'+str(smaller_mid[i]))
+                answers.append(result_formula)
+                if smaller_diff[i] > self.max_diff:
+                    self.max_diff = smaller_diff[i]
+                    self.max_diff_formula = result_formula
+            if greater[i]:
+                result_formula = formula.replace(PRQUERY, '>'+str(greater_mid[i]))
+                answers.append(result_formula)
+                if greater_diff[i] > self.max_diff:
+                    self.max_diff = greater_diff[i]
+                    self.max_diff_formula = result_formula
 
         if answers != []:
             self.all_results.update({self.formula_size: answers})
@@ -154,100 +442,355 @@ class Separator:
         else:
             return False
 
-    def run_prism(self, pm_file, tl_file):
+    def cached_model_check(self, pm_file, tl_file, precision=None):
+        '''
+        Model checking through the result cache: only the properties without a cached result are checked
+        '''
+        if self.cache is None:
+            return self.model_check(pm_file, tl_file, precision)
+
+        labels, properties = read_property_file(tl_file)
+        # coarse results are cached apart from the exact ones
+        variant = f' epsilon={precision}' if precision is not None else ''
+        keys = [self.cache.key(pm_file, labels, prop, variant) for prop in properties]
+        cached = self.cache.get_many(keys)
+        missing = [i for i in range(len(keys)) if keys[i] not in cached]
+
+        new_results = []
+        if missing:
+            if len(missing) == len(properties):
+                missing_file = tl_file
+            else:
+                missing_file = os.path.join(os.path.dirname(tl_file), f'missing-{os.getpid()}-{threading.get_ident()}.pltl')
+                with open(missing_file, 'w') as f:
+                    f.write(labels)
+                    for i in missing:
+                        f.write(properties[i] + '\n')
+            output_dict = self.model_check(pm_file, missing_file, precision)
+            if missing_file != tl_file:
+                os.remove(missing_file)
+            new_results = list(output_dict.items()) if output_dict else []
+            if len(new_results) != len(missing):
+                # results cannot be matched with the properties, check the whole file without the cache
+                print(f'Could not match the results of {pm_file} with the cache, checking without it')
+                return self.model_check(pm_file, tl_file, precision)
+            self.cache.put_many([(keys[i], formula, vector) for i, (formula, vector) in zip(missing, new_results)])
+
+        output_dict = {}
+        new_results = iter(new_results)
+        for key in keys:
+            formula, vector = cached[key] if key in cached else next(new_results)
+            output_dict[formula] = vector
+        return output_dict
+
+    def model_check(self, pm_file, tl_file, precision=None):
+        '''
+        Computes the results of all properties of tl_file on the model pm_file with the selected backend,
+        within the global model checking budget. With a precision, the results are computed by interval
+        iteration up to that absolute error. With a chunk size, larger property files are checked by chunks
+        and the results merged.
+        '''
+        if self.chunk_size is None:
+            return self.check_file(pm_file, tl_file, precision)
+        labels, properties = read_property_file(tl_file)
+        if len(properties) <= self.chunk_size:
+            return self.check_file(pm_file, tl_file, precision)
+
+        output_dict = {}
+        chunk_file = os.path.join(os.path.dirname(tl_file), f'chunk-{os.getpid()}-{threading.get_ident()}.pltl')
+        for start in range(0, len(properties), self.chunk_size):
+            chunk = properties[start:start+self.chunk_size]
+            with open(chunk_file, 'w') as f:
+                f.write(labels)
+                for prop in chunk:
+                    f.write(prop + '\n')
+            try:
+                output_dict.update(self.check_chunk(pm_file, chunk_file, precision, len(set(chunk)), start // self.chunk_size))
+            finally:
+                os.remove(chunk_file)
+        return output_dict
+
+    def check_chunk(self, pm_file, chunk_file, precision, num_properties, index):
+        '''
+        Checks a chunk of properties until all of them get a result, at most 1 + chunk_retries times, and
+        records its time, attempts and peak memory (of the PRISM process, unknown for the other backends)
+        '''
+        t0 = time.time()
+        for attempt in range(1, self.chunk_retries + 2):
+            try:
+                output_dict = self.check_file(pm_file, chunk_file, precision)
+            except Exception as e:
+                print(f'Chunk {index} of {pm_file} failed: {e}')
+                output_dict = None
+            if output_dict and len(output_dict) >= num_properties:
+                break
+            print(f'Chunk {index} of {pm_file}: attempt {attempt} of {self.chunk_retries + 1} failed')
+        else:
+            raise RuntimeError(f'Could not check chunk {index} of {pm_file} ({num_properties} properties)')
+
+        rusage = self.pool.last_rusage() if self.backend == 'prism' and self.scheduler is None else None
+        with self.chunk_lock:
+            self.chunk_stats.append({'model': os.path.basename(pm_file), 'chunk': index, 'properties': num_properties,
+                                     'attempts': attempt, 'time': round(time.time() - t0, 3),
+                                     'peak_memory_mb': round(rusage.ru_maxrss / 1024, 1) if rusage is not None else None})
+        return output_dict
+
+    def chunk_summary(self):
+        '''
+        Number of chunks checked, retries and highest peak memory of a PRISM process, for the info file
+        '''
+        peaks = [stat['peak_memory_mb'] for stat in self.chunk_stats if stat['peak_memory_mb'] is not None]
+        return {'chunks_checked': len(self.chunk_stats),
+                'chunk_retries': sum(stat['attempts'] - 1 for stat in self.chunk_stats),
+                'chunk_peak_memory_mb': max(peaks) if peaks else None}
+
+    def check_file(self, pm_file, tl_file, precision=None):
         '''
-        Function that runs PRISM on a given DTMC file
+        Checks a whole property file on the model in one call of the backend (or one task of the scheduler)
         '''
-        tl_folder = os.path.dirname(tl_file)
-        logging_file = tl_folder+'/log-check.log'
-        command = [self.prism_binary, pm_file, tl_file] + self.prism_flags + ['--mainlog', logging_file]
+        if self.scheduler is not None:
+            output_dict = self.scheduler.check(pm_file, tl_file, self.compact, self.model_store is not None, precision)
+            if output_dict is not None:
+                return output_dict
+            print(f'Scheduled check of {pm_file} failed, checking it locally')
+        if check_budget is not None:
+            check_budget.acquire()
         try:
-            proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            proc.wait()
-            #result = proc.communicate()[0].decode('utf-8')
-            
-            #print(result)
-            #with open('output.txt', 'w') as f:
-            #    f.write(result)
+            if self.backend == 'native':
+                return self.native_checker.check(pm_file, tl_file, compact=self.compact, epsilon=precision)
+            return self.run_prism(pm_file, tl_file, precision)
+        finally:
+            if check_budget is not None:
+                check_budget.release()
 
-            with open(logging_file, 'r') as f:
-                result = f.read()
-            
-            #print(result)
-            os.remove(logging_file)
-            output_dict = self.extract_results(result)
-            return output_dict
-        except subprocess.CalledProcessError as e:
-            print(f"Error running PRISM on {pm_file}: {e}")
-            return None
+    def run_prism(self, pm_file, tl_file, precision=None):
+        '''
+        Function that runs PRISM on a given DTMC file, its output is parsed while PRISM runs
+        '''
+        flags = self.prism_flags
+        if precision is not None:
+            flags = flags + ['-intervaliter', '-absolute', '-epsilon', str(precision)]
+        command = [os.path.abspath(pm_file), os.path.abspath(tl_file)] + flags
+        entry = nullcontext()
+        if self.model_store is not None:
+            # the explicit model is not removed by another run while PRISM imports it
+            labels, properties = read_property_file(tl_file)
+            entry = self.model_store.using(self.model_store.base(pm_file, labels))
+        with entry:
+            if self.model_store is not None:
+                base = self.model_store.prism_model(pm_file, labels, self.pool)
+                if base is not None:
+                    # the labels are part of the explicit model, the property file only keeps the properties
+                    props_file = os.path.join(os.path.dirname(os.path.abspath(tl_file)), f'props-{os.getpid()}-{threading.get_ident()}.pltl')
+                    with open(props_file, 'w') as f:
+                        f.write('\n'.join(properties) + '\n')
+                    command = ['-importtrans', base + '.tra', '-importstates', base + '.sta', '-importlabels', base + '.lab',
+                               '-dtmc', '-explicit', props_file] + flags
+            try:
+                return self.pool.stream(command, self.parse_prism_output)
+            except (OSError, subprocess.CalledProcessError, ValueError) as e:
+                # PRISM could not run, failed (e.g. killed when out of memory) or its output could not be parsed
+                print(f"Error running PRISM on {pm_file}: {e}")
+                return None
+            finally:
+                if '-importtrans' in command:
+                    os.remove(command[command.index('-explicit') + 1])
+
+    def prepare_models(self, labels):
+        '''
+        Compiles all the example models into explicit models before the search (once per model and labels)
+        '''
+        models = self.positive + self.negative
+        if self.backend == 'native':
+            list(self.executor.map(self.model_store.native_model, models, [labels] * len(models)))
+        else:
+            list(self.executor.map(self.model_store.prism_model, models, [labels] * len(models), [self.pool] * len(models)))
 
-    def extract_results(self, text):
+    def parse_prism_output(self, lines):
         '''
-        Function that parses the PRISM output
+        Parses the PRISM output line by line while PRISM runs: the blocks of the
+        properties start at separator lines, the formula is the first paragraph of a block and the exported
+        vector follows its result. Vectors are converted by chunks into a buffer preallocated with the
+        number of states of the model.
         '''
         output_dict = {}
-        if "\n0 properties" in text or text == "":
+        no_output = True
+        no_properties = False
+        num_states = 0
+        formula = None
+        paragraph = []
+        in_block = False
+        after_result = False
+        is_bool = False
+        lines = iter(lines)
+        for line in lines:
+            no_output = False
+            text = line.rstrip('\n')
+            if text.endswith(PRISM_SEPARATOR):
+                in_block, formula, paragraph, after_result = True, None, [], False
+                continue
+            if not in_block:
+                if text.startswith('States:'):
+                    num_states = int(text.split()[1])
+                elif text.startswith('0 properties'):
+                    no_properties = True
+                continue
+
+            if text == '':
+                if formula is None and not paragraph:
+                    # PRISM leaves a blank line after the separator
+                    continue
+                # end of a paragraph
+                if formula is None:
+                    formula = '\n'.join(paragraph).strip()
+                    if formula == '':
+                        in_block = False
+                elif paragraph and any('Result' in l for l in paragraph):
+                    result = '\n'.join(paragraph)
+                    after_result = True
+                    is_bool = 'true' in result or 'false' in result
+                paragraph = []
+                continue
+
+            if after_result and not paragraph:
+                # the paragraph following the result is the exported vector
+                after_result = False
+                if text != 'v = [':
+                    raise ValueError(f'PRISM output is not parsed properly: {formula} is followed by {text[:10]!r}')
+                output_dict[formula] = self.read_vector(lines, num_states, is_bool)
+                continue
+            paragraph.append(text)
+
+        if no_output or no_properties:
             print('No properties found')
             return []
-        all_outputs = text.split('---------------------------------------------------------------------\n')[1:]
-        #print(len(all_outputs))
-        for output in all_outputs:
-            output_list = output.split('\n\n')
-            formula = output_list[0].strip()
-            #print(formula)
-            if formula == '':
-                continue
-            for i in range(len(output_list)):
-                s = output_list[i]
-                #print(s)
-                if 'Result' in s:
-                    if 'true' in s or 'false' in s:
-                        formula_result = True if 'true' in s else False
-                        vector_text = output_list[i+1]
-                        if 'v = [\n' == vector_text[:6]:
-                            formula_vector = np.array(list(map(bool,vector_text[6:-3].split('\n'))))
-                        else:
-                            raise ValueError('PRISM output is not parsed properly')
-                    else:
-                        formula_result = round(float(s.split(' ')[1]), 5)
-                        vector_text = output_list[i+1]
-                        if 'v = [\n' == vector_text[:6]:
-                            formula_vector = np.array(list(map(float,vector_text[6:-3].split('\n'))))
-                        else:
-                            print(formula,vector_text[:10])
-                            raise ValueError('PRISM output is not parsed properly')
-            output_dict[formula] = formula_vector
         return output_dict
 
+    def read_vector(self, lines, num_states, is_bool):
+        '''
+        Reads the entries of an exported vector up to its closing bracket
+        '''
+        if self.compact:
+            return self.read_compact_vector(lines, is_bool)
+        vector = np.zeros(max(num_states, 1), dtype=bool if is_bool else np.float64)
+        size = 0
+        chunk = []
+        for line in lines:
+            if line.lstrip().startswith(']'):
+                break
+            chunk.append(line)
+            if len(chunk) == VECTOR_CHUNK:
+                vector, size = self.store_chunk(vector, size, chunk, is_bool)
+                chunk = []
+        vector, size = self.store_chunk(vector, size, chunk, is_bool)
+        return vector[:size]
+
+    def read_compact_vector(self, lines, is_bool):
+        '''
+        Reduces an exported vector to [first value, minimum, maximum] chunk by chunk
+        '''
+        summary = None
+        chunk = []
+        for line in lines:
+            if line.lstrip().startswith(']'):
+                break
+            chunk.append(line)
+            if len(chunk) == VECTOR_CHUNK:
+                summary = self.reduce_chunk(summary, chunk, is_bool)
+                chunk = []
+        summary = self.reduce_chunk(summary, chunk, is_bool)
+        return np.array(summary)
+
+    def reduce_chunk(self, summary, chunk, is_bool):
+        '''
+        Updates the [first value, minimum, maximum] summary of a vector with a chunk of its lines
+        '''
+        if not chunk:
+            return summary
+        values, _ = self.store_chunk(np.zeros(0, dtype=bool if is_bool else np.float64), 0, chunk, is_bool)
+        if summary is None:
+            return [values[0], values.min(), values.max()]
+        return [summary[0], min(summary[1], values.min()), max(summary[2], values.max())]
+
+    def store_chunk(self, vector, size, chunk, is_bool):
+        '''
+        Converts a chunk of lines of a vector and stores them after its first size entries, growing the buffer if needed
+        '''
+        if not chunk:
+            return vector, size
+        if is_bool:
+            values = np.array([value.strip() == 'true' for value in chunk])
+        else:
+            values = np.fromstring(''.join(chunk), sep=' ')
+        if size + len(values) > len(vector):
+            vector = np.resize(vector, max(2 * len(vector), size + len(values)))
+        vector[size:size+len(values)] = values
+        return vector, size + len(values)
+
     def verify_formula(self):
 
         for pos in self.positive:
-            output_dict = self.run_prism(pos, self.answer_file)
+            output_dict = self.model_check(pos, self.answer_file)
             
             for formula in output_dict:
                 if not output_dict[formula]:
                     print('There is a problem in %s for file %s' % (formula, pos))
         
         for neg in self.negative:
-            output_dict = self.run_prism(neg, self.answer_file)
+            output_dict = self.model_check(neg, self.answer_file)
             for formula in output_dict:
                 if output_dict[formula]:
                     print('There is a problem in %s for file %s' % (formula, neg))
 
-def find_pltl_formula(prism_binary, atoms, labels, positive, negative, max_size, verbose, delta_param=0.05, info_file='info'):
+    def close(self):
+        '''
+        Shuts down the PRISM workers and the result cache
+        '''
+        self.executor.shutdown()
+        self.pool.close()
+        if self.cache is not None:
+            self.cache.close()
+
+def split_batch(prefilter, formulas, bsc_policy):
+    '''
+    Splits a batch into the formulas kept by the statistical pre-filter and the dropped formulas to check only if
+    no kept formula separates the examples (lazy policy, for the boolean combinations), the skip policy leaves them out
+    '''
+    kept, dropped = prefilter.split(formulas)
+    if bsc_policy == 'skip':
+        return kept, []
+    if not kept:
+        return dropped, []
+    return kept, dropped
+
+def find_pltl_formula(prism_binary, atoms, labels, positive, negative, max_size, verbose, delta_param=0.05, info_file='info', nailgun=False, num_workers=None, backend='prism', cache_file=None, cache_size=1024, obs_eq=None, spot_memo_dir=None, grammar_workers=1, scheduler=None, compact=False, explicit_models=False, bisimulation=False, smc_alpha=None, smc_samples=1000, smc_horizon=100, early_abort=False, bsc_policy='lazy', precision=None, incremental=False, pipeline=False, chunk_size=None, chunk_retries=2, resume=False):
     '''
     Main function that combines all three procedures: GBE, PTS, and BSC
     '''
     max_depth = 2
     external_folder = '/'.join(positive[0].split('/')[:-1])
 
-    # remove all the files and folders from the previous run
-    if os.path.exists(f'{external_folder}/temp_{info_file}'):
-        for file in os.listdir(f'{external_folder}/temp_{info_file}'):
-            os.remove(os.path.join(f'{external_folder}/temp_{info_file}', file))
-        os.rmdir(f'{external_folder}/temp_{info_file}')
-    if os.path.exists(f'{external_folder}/answer_{info_file}.pltl'):
-        os.remove(f'{external_folder}/answer_{info_file}.pltl')
+    # the state of the run is saved after every (size, depth) batch, a run with resume continues after the last saved batch
+    run_config = {'atoms': atoms, 'labels': labels, 'positive': positive, 'negative': negative, 'max_size': max_size, 'delta': delta_param,
+                  'obs_eq': obs_eq, 'bisimulation': bisimulation, 'smc_alpha': smc_alpha, 'smc_samples': smc_samples, 'smc_horizon': smc_horizon,
+                  'early_abort': early_abort, 'bsc_policy': bsc_policy, 'precision': precision}
+    checkpoint = Checkpoint(f'{external_folder}/checkpoint_{info_file}.pkl', run_config, f'{external_folder}/config_{info_file}.json')
+    if resume and checkpoint.is_complete(f'{external_folder}/{info_file}.json'):
+        print(f'Run {info_file} in {external_folder} is already complete')
+        return
+    saved_state = checkpoint.load() if resume else None
+
+    # remove all the files and folders from the previous run (e.g. the explicit models of the quotient models)
+    if saved_state is None:
+        if os.path.exists(f'{external_folder}/temp_{info_file}'):
+            shutil.rmtree(f'{external_folder}/temp_{info_file}')
+        if os.path.exists(f'{external_folder}/answer_{info_file}.pltl'):
+            os.remove(f'{external_folder}/answer_{info_file}.pltl')
+        # the info file and the configuration mark a complete run
+        for done_file in [f'{external_folder}/{info_file}.json', f'{external_folder}/config_{info_file}.json']:
+            if os.path.exists(done_file):
+                os.remove(done_file)
+        checkpoint.remove()
 
     #create a temporary folder to store the pltl files
     folder = f'{external_folder}/temp_{info_file}'
@@ -256,60 +799,137 @@ def find_pltl_formula(prism_binary, atoms, labels, positive, negative, max_size,
     print(f"Folder created at {folder}")
     
     # Starting the three procedures
-    grammar = GrammarGenPLTL(atoms, max_depth, max_size)
-    bsc = Boolcomb(max_size=max_size, max_initial_set=5, delta=delta_param)
-    sep = Separator(prism_binary=prism_binary, positive=positive, negative=negative, verbose=verbose, delta=delta_param, bsc=bsc)
+    grammar = GrammarGenPLTL(atoms, max_depth, max_size, num_workers=grammar_workers)
+    if spot_memo_dir:
+        os.makedirs(spot_memo_dir, exist_ok=True)
+        grammar.spot_memo.load(spot_memo_file(spot_memo_dir, atoms))
+    bsc = Boolcomb(max_size=max_size, max_initial_set=10, delta=delta_param)
+    cache = ResultCache(cache_file, max_size_mb=cache_size) if cache_file else None
+    model_store = ModelStore() if explicit_models else None
+    check_positive, check_negative = positive, negative
+    quotient_stats = None
+    if bisimulation:
+        # the formulas only see the atoms: the models are checked through their bisimulation quotients over
+        # the atoms, which carry the label definitions, so the property files do not define them anymore
+        quotient_files, quotient_stats = quotient_models(positive + negative, atoms, labels, folder)
+        check_positive, check_negative = quotient_files[:len(positive)], quotient_files[len(positive):]
+        labels = ''
+    sep = Separator(prism_binary=prism_binary, positive=check_positive, negative=check_negative, verbose=verbose, delta=delta_param, bsc=bsc, nailgun=nailgun, num_workers=num_workers, backend=backend, cache=cache, scheduler=scheduler, compact=compact, model_store=model_store, early_abort=early_abort, bsc_policy=bsc_policy, precision=precision, incremental=incremental, chunk_size=chunk_size, chunk_retries=chunk_retries)
     
     # Initialize GBE
     grammar.heuristics['discard_heur'] = True
     grammar.heuristics_counter['discard_heur'] = 0
     grammar.heuristics_times['discard_heur'] = 0
+    # observational equivalence pruning, obs_eq is the number of digits the probabilities are rounded to
+    grammar.heuristics['obs_eq'] = obs_eq is not None
+    grammar.heuristics_counter['obs_eq'] = 0
+    grammar.heuristics_times['obs_eq'] = 0
     grammar.init_formulas()
+    if model_store is not None:
+        sep.prepare_models(labels)
+    prefilter = None
+    if smc_alpha is not None:
+        # only the formulas that may separate the examples according to sampled paths are model checked
+        prefilter = SMCPrefilter(check_positive, check_negative, atoms, labels, delta_param, only_greater=sep.only_greater, only_smaller=sep.only_smaller,
+                                 alpha=smc_alpha, num_samples=smc_samples, horizon=smc_horizon)
+        if bsc_policy == 'skip':
+            print('Warning: the formulas dropped by the SMC pre-filter are not checked, the boolean combinations only use the kept formulas')
+    grammar_pipeline = GrammarPipeline(grammar) if pipeline else None
     
     found_minimal = False
     found_pts = False
     found_bsc = False
+    # last complete (size, depth) batch
+    last_batch = (0, 0)
+    if saved_state is not None:
+        bsc = checkpoint.restore(saved_state, grammar, sep, bsc, prefilter, grammar_pipeline)
+        last_batch = saved_state['batch']
+        found_minimal, found_pts, found_bsc = saved_state['flags']
+        print(f'Resuming {info_file} after size {last_batch[0]} and depth {last_batch[1]}')
+    if grammar_pipeline is not None and grammar.current_size < max_size:
+        # the next size is enumerated while the current one is checked
+        grammar_pipeline.start()
 
-    file_path = os.path.join(folder, f'temp_{1}_{0}.pltl')
-    print(f"#### Checking for size {1} and depth {0}")
-    with open(file_path, 'w') as f:
-        if labels:
-            f.write(labels)
-        for formula in grammar.formula_list[(0,1)]:
-            f.write("P=? [ " + formula.prettyPrint() + " ]\n")
-            
+    if last_batch < (1, 0):
+        file_path = os.path.join(folder, f'temp_{1}_{0}.pltl')
+        print(f"#### Checking for size {1} and depth {0}")
+        formula_listformat = list(grammar.formula_list[(0,1)])
+        deferred, deferred_file = [], None
+        if prefilter is not None:
+            formula_listformat, deferred = split_batch(prefilter, formula_listformat, bsc_policy)
+        with open(file_path, 'w') as f:
+            if labels:
+                f.write(labels)
+            for formula in formula_listformat:
+                f.write("P=? [ " + formula.prettyPrint() + " ]\n")
+        if deferred:
+            deferred_file = os.path.join(folder, f'temp_{1}_{0}_deferred.pltl')
+            with open(deferred_file, 'w') as f:
+                if labels:
+                    f.write(labels)
+                for formula in deferred:
+                    f.write("P=? [ " + formula.prettyPrint() + " ]\n")
 
-    formula_listformat = list(grammar.formula_list[(0,1)])
-    found, discard_index = sep.generate_probs(file_path, (1,0))
-    if found:
-        print("Status: Found separating formula")
-    else:
-        print("Status: No separating formula found for this size and depth")
+        found, discard_index = sep.generate_probs(file_path, (1,0), deferred_file) if formula_listformat else (False, [])
+        formula_listformat += deferred
+        if found:
+            print("Status: Found separating formula")
+        else:
+            print("Status: No separating formula found for this size and depth")
+
+        if sep.only_minimal and sep.all_results != {}:
+            print(sep.all_results)
+            if grammar_pipeline is not None:
+                grammar_pipeline.close()
+            checkpoint.remove()
+            sep.close()
+            return
+
+        if grammar.heuristics['discard_heur']:
+            for index in discard_index:
+                grammar.formula_list[(0,1)].discard(formula_listformat[index])
+                grammar.heuristics_counter['discard_heur'] += 1
+        # the coarse results are not compared, formulas within the error bound of each other would be pruned
+        if grammar.heuristics['obs_eq'] and formula_listformat:
+            grammar.apply_observational_heuristics((0,1), formula_listformat, sep.exact_results(), obs_eq)
+        checkpoint.save((1, 0), (found_minimal, found_pts, found_bsc), grammar, sep, bsc, prefilter, grammar_pipeline)
+        if spot_memo_dir:
+            grammar.spot_memo.save(spot_memo_file(spot_memo_dir, atoms))
 
-    if sep.only_minimal and sep.all_results != {}:
-        print(sep.all_results)
-        return
-    
-    if grammar.heuristics['discard_heur']:
-        for index in discard_index:
-            grammar.formula_list[(0,1)].discard(formula_listformat[index])
-            grammar.heuristics_counter['discard_heur'] += 1
-    
     # Start the main search over formulas of different sizes and depths
-    for size in range(2, max_size + 1):
-        grammar.gen_next_size()
+    for size in range(max(2, last_batch[0]), max_size + 1):
+        if size > grammar.current_size:
+            if grammar_pipeline is not None:
+                grammar_pipeline.finish()
+                if size < max_size:
+                    grammar_pipeline.start()
+            else:
+                grammar.gen_next_size()
         for depth in range(max_depth+1):
+            if (size, depth) <= last_batch:
+                continue
             if grammar.formula_list[(depth,size)]:
                 print(f"#### Checking for size {size} and depth {depth}")
                 formula_listformat = list(grammar.formula_list[(depth,size)])
+                deferred, deferred_file = [], None
+                if prefilter is not None:
+                    formula_listformat, deferred = split_batch(prefilter, formula_listformat, bsc_policy)
                 file_path = os.path.join(folder, f'temp_{size}_{depth}.pltl')
                 with open(file_path, 'w') as f:
                     if labels:
                         f.write(labels)
-                    for formula in grammar.formula_list[(depth,size)]:
+                    for formula in formula_listformat:
                         f.write("P=? [ " + formula.prettyPrint() + "]\n")
+                if deferred:
+                    deferred_file = os.path.join(folder, f'temp_{size}_{depth}_deferred.pltl')
+                    with open(deferred_file, 'w') as f:
+                        if labels:
+                            f.write(labels)
+                        for formula in deferred:
+                            f.write("P=? [ " + formula.prettyPrint() + "]\n")
                 
-                found, discard_index = sep.generate_probs(file_path, (size, depth))
+                found, discard_index = sep.generate_probs(file_path, (size, depth), deferred_file) if formula_listformat else (False, [])
+                formula_listformat += deferred
                 if found:
                     found_minimal = True
                     found_pts = True
@@ -332,6 +952,11 @@ def find_pltl_formula(prism_binary, atoms, labels, positive, negative, max_size,
                     for index in discard_index:
                         grammar.formula_list[(depth,size)].discard(formula_listformat[index])
                         grammar.heuristics_counter['discard_heur'] += 1
+                if grammar.heuristics['obs_eq'] and formula_listformat:
+                    grammar.apply_observational_heuristics((depth,size), formula_listformat, sep.exact_results(), obs_eq)
+            checkpoint.save((size, depth), (found_minimal, found_pts, found_bsc), grammar, sep, bsc, prefilter, grammar_pipeline)
+            if spot_memo_dir:
+                grammar.spot_memo.save(spot_memo_file(spot_memo_dir, atoms))
 
         if found_bsc and bsc.found_size == size+1 and sep.only_minimal:
             found_minimal = True
@@ -340,6 +965,12 @@ def find_pltl_formula(prism_binary, atoms, labels, positive, negative, max_size,
         if sep.only_minimal and found_minimal:
             break
     
+    if grammar_pipeline is not None:
+        grammar_pipeline.close()
+    sep.close()
+    if spot_memo_dir:
+        grammar.spot_memo.save(spot_memo_file(spot_memo_dir, atoms))
+
     # Printing and storing the results
     print("Here are all the formulas")
     all_formulas = []
@@ -389,9 +1020,35 @@ def find_pltl_formula(prism_binary, atoms, labels, positive, negative, max_size,
                 'PRISM_time': round(sep.PRISM_time,3),
                 'BSC_time': round(bsc.time,3)
                 }
+    if cache is not None:
+        info_dict.update(cache.stats())
+    if spot_memo_dir:
+        info_dict.update(grammar.spot_memo.stats())
+    if model_store is not None:
+        info_dict.update(model_store.stats())
+    if quotient_stats is not None:
+        info_dict.update(quotient_stats)
+    if prefilter is not None:
+        info_dict.update(prefilter.stats())
+        info_dict['smc_deferred_checked'] = sep.deferred_checked
+    if incremental:
+        info_dict.update({'incremental_evaluations': sep.native_checker.incremental_evaluations, 'automaton_evaluations': sep.native_checker.automaton_evaluations})
+    if precision is not None:
+        info_dict.update({'coarse_time': round(sep.coarse_time, 3), 'refine_time': round(sep.refine_time, 3), 'refined_formulas': sep.refined})
+    if grammar_pipeline is not None:
+        info_dict.update(grammar_pipeline.stats())
+    if chunk_size is not None:
+        info_dict.update(sep.chunk_summary())
+        # time, attempts and peak memory of every chunk
+        with open(f'{external_folder}/chunks_{info_file}.json', 'w') as f:
+            json.dump(sep.chunk_stats, f)
+    if early_abort:
+        info_dict.update({'early_abort_skipped': sep.abort_skipped, 'early_abort_completed': sep.abort_completed})
     heuristics_dict = {k:';'.join([str(grammar.heuristics[k]), str(grammar.heuristics_counter[k]), str(round(grammar.heuristics_times[k],3))]) for k in grammar.heuristics}
     info_dict.update(heuristics_dict)
 
     print(info_dict)
     with open(f'{external_folder}/{info_file}.json', 'w') as f:
-        json.dump(info_dict, f)
\ No newline at end of file
+        json.dump(info_dict, f)
+    # the run is complete
+    checkpoint.complete()
\ No newline at end of file
@@ -0,0 +1,173 @@
+import time
+import numpy as np
+from prism_model import PrismModel
+
+
+def sample_paths(dtmc, num_samples, horizon, rng):
+    '''
+    Samples paths of horizon steps from the first state of the DTMC, returns their states (num_samples x horizon+1)
+    '''
+    transitions = dtmc.transitions.tocsr()
+    cumulative = np.cumsum(transitions.data)
+    starts, ends = transitions.indptr[:-1], transitions.indptr[1:]
+    offsets = np.where(starts > 0, cumulative[np.maximum(starts - 1, 0)], 0)
+    row_sums = cumulative[np.maximum(ends - 1, 0)] - offsets
+
+    paths = np.zeros((num_samples, horizon + 1), dtype=np.int64)
+    for t in range(horizon):
+        current = paths[:, t]
+        targets = offsets[current] + rng.random(num_samples) * row_sums[current]
+        entries = np.clip(np.searchsorted(cumulative, targets, side='right'), starts[current], ends[current] - 1)
+        paths[:, t + 1] = transitions.indices[entries]
+    return paths
+
+
+def next_index(mask):
+    '''
+    For every position of every path, the first position from there on where mask holds (the path length if none)
+    '''
+    length = mask.shape[1]
+    positions = np.where(mask, np.arange(length), length)
+    return np.flip(np.minimum.accumulate(np.flip(positions, axis=1), axis=1), axis=1)
+
+
+def absorbing_states(dtmc):
+    '''
+    States whose only transition is a self-loop
+    '''
+    transitions = dtmc.transitions.tocsr()
+    single = np.diff(transitions.indptr) == 1
+    absorbing = np.zeros(dtmc.num_states, dtype=bool)
+    rows = np.flatnonzero(single)
+    absorbing[rows] = transitions.indices[transitions.indptr[rows]] == rows
+    return absorbing
+
+
+def evaluate(formula, atoms, closed):
+    '''
+    Three-valued evaluation of an LTL formula on every position of finite path prefixes: returns whether
+    the formula is surely true and whether it is surely false on every continuation of the prefix.
+    The closed paths end in an absorbing state, they only continue with it and are decided everywhere.
+    '''
+    true, false = evaluate_prefix(formula, atoms, closed)
+    if formula.label in ['X', 'F', 'G', 'U']:
+        false = false | (closed & ~true)
+    return true, false
+
+
+def evaluate_prefix(formula, atoms, closed):
+
+    label = formula.label
+    if formula.left is None:
+        if label.startswith('!'):
+            values = atoms[label[1:].strip('"')]
+            return ~values, values
+        values = atoms[label.strip('"')]
+        return values, ~values
+
+    true1, false1 = evaluate(formula.left, atoms, closed)
+    if label == '!':
+        return false1, true1
+    if label == 'X':
+        true, false = np.zeros_like(true1), np.zeros_like(false1)
+        true[:, :-1], false[:, :-1] = true1[:, 1:], false1[:, 1:]
+        true[:, -1] = closed[:, 0] & true1[:, -1]
+        return true, false
+    length = true1.shape[1]
+    if label == 'F':
+        return next_index(true1) < length, np.zeros_like(false1)
+    if label == 'G':
+        surely_false = next_index(false1) < length
+        return closed & ~surely_false, surely_false
+
+    true2, false2 = evaluate(formula.right, atoms, closed)
+    if label == '&':
+        return true1 & true2, false1 | false2
+    if label == '|':
+        return true1 | true2, false1 & false2
+    if label == 'U':
+        # true: the right operand holds before the left one stops holding,
+        # false: both fail before the right one stops failing
+        first_true2 = next_index(true2)
+        first_both_false = next_index(false1 & false2)
+        return (first_true2 < length) & (first_true2 <= next_index(~true1)), (first_both_false < length) & (first_both_false < next_index(~false2))
+    raise ValueError(f'Unsupported operator {label} in the statistical pre-filter')
+
+
+class SMCPrefilter:
+    '''
+    Statistical model checking pre-filter: estimates the probability of the formulas in the first state of
+    every model on sampled paths, with Hoeffding confidence intervals (Bonferroni-corrected over the
+    models), and drops the formulas that surely cannot separate the examples by more than delta, so that
+    they are not model checked. A separating formula is dropped with probability at most alpha.
+    '''
+    def __init__(self, positive, negative, atoms, labels, delta, only_greater=True, only_smaller=False, alpha=0.01, num_samples=1000, horizon=100, seed=0):
+
+        t0 = time.time()
+        self.num_pos = len(positive)
+        self.num_models = len(positive) + len(negative)
+        self.num_samples = num_samples
+        self.delta = delta
+        self.only_greater = only_greater
+        self.only_smaller = only_smaller
+        # the undecided paths count as satisfying for the upper bound and as violating for the lower bound
+        self.epsilon = np.sqrt(np.log(2 * self.num_models / alpha) / (2 * num_samples))
+
+        rng = np.random.default_rng(seed)
+        names = [atom.strip('"') for atom in atoms]
+        path_labels = {name: [] for name in names}
+        closed = []
+        for pm_file in positive + negative:
+            dtmc = PrismModel.from_file(pm_file).build()
+            if labels:
+                dtmc.add_labels(labels)
+            paths = sample_paths(dtmc, num_samples, horizon, rng)
+            closed.append(absorbing_states(dtmc)[paths[:, -1]])
+            for name in names:
+                if name not in dtmc.labels:
+                    raise ValueError(f'Unknown label "{name}" in {pm_file}')
+                path_labels[name].append(dtmc.labels[name][paths])
+        # the paths of all the models are evaluated together
+        self.atoms = {name: np.concatenate(values) for name, values in path_labels.items()}
+        self.closed = np.concatenate(closed)[:, None]
+
+        self.checked = 0
+        self.dropped = 0
+        self.time = time.time() - t0
+
+    def bounds(self, formula):
+        '''
+        Confidence interval of the probability of the formula on every model
+        '''
+        true, false = evaluate(formula, self.atoms, self.closed)
+        surely_true = true[:, 0].reshape(self.num_models, self.num_samples).mean(axis=1)
+        surely_false = false[:, 0].reshape(self.num_models, self.num_samples).mean(axis=1)
+        return np.clip(surely_true - self.epsilon, 0, 1), np.clip(1 - surely_false + self.epsilon, 0, 1)
+
+    def can_separate(self, formula):
+        '''
+        Whether the intervals allow a separation as accepted by Separator.check_separation
+        '''
+        lower, upper = self.bounds(formula)
+        pos_lower, neg_lower = lower[:self.num_pos], lower[self.num_pos:]
+        pos_upper, neg_upper = upper[:self.num_pos], upper[self.num_pos:]
+        greater = self.only_greater and pos_upper.min() - neg_lower.max() > self.delta and pos_upper.min() >= 0.8
+        smaller = self.only_smaller and neg_upper.min() - pos_lower.max() > self.delta
+        return greater or smaller
+
+    def split(self, formulas):
+        '''
+        Splits the formulas into those that may separate the examples and those dropped
+        '''
+        t0 = time.time()
+        survivors, dropped = [], []
+        for formula in formulas:
+            (survivors if self.can_separate(formula) else dropped).append(formula)
+        self.checked += len(formulas)
+        self.dropped += len(dropped)
+        print(f'SMC pre-filter: {len(dropped)} of {len(formulas)} formulas dropped')
+        self.time += time.time() - t0
+        return survivors, dropped
+
+    def stats(self):
+        return {'smc_checked': self.checked, 'smc_dropped': self.dropped, 'smc_time': round(self.time, 3)}
@@ -0,0 +1,106 @@
+import unittest
+
+import numpy as np
+
+from separator import Separator, PRISM_SEPARATOR
+
+
+# output of PRISM with --exportvector stdout on a model of 3 states, each separator is followed by a blank line
+PRISM_OUTPUT = f'''PRISM
+=====
+
+Version: 4.8
+
+Parsing model file "pos_0_0.pm"...
+
+2 properties:
+(1) P=? [ F "a" ]
+(2) P=? [ (G "b") ]
+
+Building model...
+
+Type:        DTMC
+States:      3 (1 initial)
+Transitions: 5
+
+{PRISM_SEPARATOR}
+
+Model checking: P=? [ F "a" ]
+
+Building deterministic Rabin automaton (for F "L0")...
+DRA has 2 states, 1 Rabin pairs.
+
+Value in the initial state: 0.5
+
+Time for model checking: 0.012 seconds.
+
+Result: 0.5 (exact floating point)
+
+v = [
+0.5
+1.0
+0.0
+];
+
+{PRISM_SEPARATOR}
+
+Model checking: P=? [ (G "b") ]
+
+Value in the initial state: 0.25
+
+Time for model checking: 0.008 seconds.
+
+Result: 0.25 (exact floating point)
+
+v = [
+0.25
+0.0
+0.75
+];
+
+'''
+
+
+def extract_results(text):
+    '''
+    Reference parser of the complete PRISM output, as it was before the output was parsed while PRISM runs
+    '''
+    output_dict = {}
+    if "\n0 properties" in text or text == "":
+        return []
+    for output in text.split(PRISM_SEPARATOR + '\n')[1:]:
+        output_list = output.split('\n\n')
+        formula = output_list[0].strip()
+        if formula == '':
+            continue
+        for i in range(len(output_list)):
+            if 'Result' in output_list[i]:
+                vector_text = output_list[i+1]
+                if 'v = [\n' != vector_text[:6]:
+                    raise ValueError('PRISM output is not parsed properly')
+                output_dict[formula] = np.array(list(map(float, vector_text[6:-3].split('\n'))))
+    return output_dict
+
+
+class ParsePrismOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sep = Separator([], [], False, 0.05, None, num_workers=1)
+
+    def tearDown(self):
+        self.sep.close()
+
+    def test_same_results_as_reference(self):
+        expected = extract_results(PRISM_OUTPUT)
+        results = self.sep.parse_prism_output(PRISM_OUTPUT.splitlines(True))
+        self.assertEqual(len(expected), 2)
+        self.assertEqual(results.keys(), expected.keys())
+        for formula in expected:
+            np.testing.assert_array_equal(results[formula], expected[formula])
+
+    def test_no_properties(self):
+        self.assertEqual(self.sep.parse_prism_output('PRISM\n\n0 properties\n'.splitlines(True)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()